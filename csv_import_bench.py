@@ -0,0 +1,486 @@
+#!/usr/bin/python3
+
+# This script is Python 3 specific
+# Benchmark for csv_import_update.py - generates a synthetic CSV with a
+# matching INI, loads a seed table and times the import in each mode.
+
+import re
+import sys
+import os
+import os.path
+import json
+import time
+import random
+import shutil
+import string
+import hashlib
+import platform
+import tempfile
+import subprocess
+import configparser
+
+import psycopg2                 # PostgreSQL
+
+
+# HELP
+help_string                     = """USAGE: csv_import_bench.py [--rows N] [--columns N] [--keys N] [--ratio I:U:S] [--varchar N] [--modes LIST] [--report FILE] [--start-postgres [--pg-bin DIR]] [--host H] [--port P] [--name DB] [--user U] [--pass P] [--keep]
+
+EXAMPLE:
+    ./csv_import_bench.py --start-postgres
+    ./csv_import_bench.py --rows 1000000 --columns 20 --ratio 5:15:80 --modes batch,snapshot,copy
+    ./csv_import_bench.py --host localhost --name benchdb --user postgres --pass secret
+
+--rows N
+    CSV rows (default 100000).
+--columns N
+    Table columns, including the key columns (default 8).
+--keys N
+    Key columns (default 2).
+--ratio I:U:S
+    Share of CSV rows which are inserted, updated and skipped
+    (default 20:30:50).
+--varchar N
+    Length of the generated values (default 12).
+--modes LIST
+    Comma separated import modes to time (default: all). Modes:
+    {0}
+--report FILE
+    JSON report file (default csv_import_bench.json).
+--start-postgres
+    Start a throw-away PostgreSQL server in a temporary directory
+    (needs initdb and pg_ctl, from PATH or --pg-bin).
+--host, --port, --name, --user, --pass
+    Use an existing PostgreSQL database instead. The table
+    csv_import_bench is dropped and created there for each mode.
+--keep
+    Do not delete the generated CSV and INI files.
+
+"""
+
+
+# SETUP
+
+execpath                        = os.path.dirname(os.path.abspath(__file__))
+confpath                        = "{0}/conf".format(execpath)
+import_script                   = "{0}/csv_import_update.py".format(execpath)
+
+bench_name                      = "csv_import_bench"    # Table, INI and CSV name
+bench_seed                      = 20200720
+
+# Mode name, [get_database_data] settings, [update_database_data] settings, extra arguments
+bench_modes                     = [
+    ("row",         {},                                 {},                                                             []),
+    ("batch",       {"lookup_batch_size": "1000"},      {},                                                             []),
+    ("batch_write", {"lookup_batch_size": "1000"},      {"write_batch_size": "1000", "commit_every": "1000"},           []),
+    ("snapshot",    {"lookup": "snapshot"},             {"write_batch_size": "1000", "commit_every": "1000"},           []),
+    ("async",       {"lookup_batch_size": "1000"},      {"engine": "async"},                                            []),
+    ("copy",        {},                                 {"engine": "copy"},                                             []),
+    ("workers",     {"lookup_batch_size": "1000"},      {"write_batch_size": "1000", "commit_every": "1000"},           ["--workers", "4"])
+]
+
+settings                        = {
+    "rows"          : 100000,
+    "columns"       : 8,
+    "keys"          : 2,
+    "ratio"         : (20, 30, 50),
+    "varchar"       : 12,
+    "modes"         : [mode[0] for mode in bench_modes],
+    "report"        : "csv_import_bench.json",
+    "start_postgres": False,
+    "pg_bin"        : None,
+    "keep"          : False,
+    "db"            : {}
+}
+
+
+def get_settings():
+    params                      = sys.argv[1:]
+    
+    while (len(params) > 0):
+        param                   = params.pop(0).lower()
+        
+        if (param in ["-h", "--help"]):
+            print(help_string.format(', '.join(settings["modes"])))
+            sys.exit(0)
+        
+        if (param == "--start-postgres"):
+            settings["start_postgres"] = True
+            continue
+        
+        if (param == "--keep"):
+            settings["keep"]    = True
+            continue
+        
+        if (len(params) == 0):
+            raise Exception("{0} needs a value.".format(param))
+        value                   = params.pop(0)
+        
+        if (param in ["--rows", "--columns", "--keys", "--varchar"]):
+            if (not value.isdigit() or int(value) < 1):
+                raise Exception("{0} needs a positive number.".format(param))
+            settings[param[2:]] = int(value)
+        elif (param == "--ratio"):
+            if (not re.match(r'^\d+:\d+:\d+$', value)):
+                raise Exception("--ratio needs INSERTS:UPDATES:SKIPS, like 20:30:50.")
+            settings["ratio"]   = tuple(int(share) for share in value.split(":"))
+        elif (param == "--modes"):
+            settings["modes"]   = value.lower().split(",")
+            for mode in settings["modes"]:
+                if (mode not in [m[0] for m in bench_modes]):
+                    raise Exception("Unknown mode: {0}".format(mode))
+        elif (param == "--report"):
+            settings["report"]  = value
+        elif (param == "--pg-bin"):
+            settings["pg_bin"]  = value
+        elif (param in ["--host", "--port", "--name", "--user", "--pass"]):
+            settings["db"][param[2:]] = value
+        else:
+            raise Exception("Unknown parameter: {0}".format(param))
+    
+    if (settings["keys"] >= settings["columns"]):
+        raise Exception("--columns must be more than --keys.")
+    
+    if (sum(settings["ratio"]) == 0):
+        raise Exception("--ratio can not be 0:0:0.")
+
+
+def get_database_settings():
+    # Same defaults as the import itself
+    config                      = configparser.ConfigParser()
+    config.read("{0}/defaults.ini".format(confpath))
+    
+    db                          = dict(config.items("postgresql"))
+    db["host"]                  = "localhost"
+    db["name"]                  = "postgres"
+    db.update(settings["db"])
+    
+    return db
+
+
+def get_pg_program(name):
+    if (settings["pg_bin"] != None):
+        return os.path.join(settings["pg_bin"], name)
+    
+    program                     = shutil.which(name)
+    if (program == None):
+        raise Exception("{0} not found. Add the PostgreSQL bin directory to PATH or use --pg-bin.".format(name))
+    
+    return program
+
+
+# A server only for this run: trust authentication, no TCP, unix
+# socket in the data directory
+def start_postgres(db, workdir):
+    datadir                     = os.path.join(workdir, "pgdata")
+    logfile                     = os.path.join(workdir, "postgres.log")
+    options                     = "-c listen_addresses='' -k {0} -p {1} -c fsync=off".format(workdir, db["port"])
+    
+    print("* Starting PostgreSQL in {0} ...".format(datadir))
+    subprocess.check_call([get_pg_program("initdb"), "-D", datadir, "-U", db["user"], "--auth=trust"], stdout=subprocess.DEVNULL)
+    
+    # pg_stat_statements is a contrib module - the server does not start
+    # with it preloaded if it is not installed
+    try:
+        subprocess.check_call([get_pg_program("pg_ctl"), "-D", datadir, "-l", logfile, "-o", options + " -c shared_preload_libraries=pg_stat_statements", "-w", "start"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        print("* pg_stat_statements is not installed - statements are not counted by the server")
+        subprocess.check_call([get_pg_program("pg_ctl"), "-D", datadir, "-l", logfile, "-o", options, "-w", "start"], stdout=subprocess.DEVNULL)
+    
+    db["host"]                  = workdir
+    db["name"]                  = "postgres"
+    
+    return datadir
+
+
+def stop_postgres(datadir):
+    print("* Stopping PostgreSQL ...")
+    subprocess.call([get_pg_program("pg_ctl"), "-D", datadir, "-m", "fast", "-w", "stop"], stdout=subprocess.DEVNULL)
+
+
+def get_connection(db):
+    return psycopg2.connect(host=db["host"], port=db["port"], database=db["name"], user=db["user"], password=db["pass"])
+
+
+def get_key_columns():
+    return ["key{0}".format(i + 1) for i in range(settings["keys"])]
+
+
+def get_data_columns():
+    return ["col{0}".format(i + 1) for i in range(settings["columns"] - settings["keys"])]
+
+
+def get_random_value(rnd):
+    return ''.join(rnd.choice(string.ascii_letters) for i in range(settings["varchar"]))
+
+
+# Seed table rows and CSV rows. Updated rows differ from the table in
+# the first data column, skipped rows are the same.
+def generate_files(workdir):
+    rnd                         = random.Random(bench_seed)
+    inserts, updates, skips     = settings["ratio"]
+    total                       = inserts + updates + skips
+    seedfn                      = os.path.join(workdir, "seed.csv")
+    csvfn                       = os.path.join(workdir, "{0}.csv".format(bench_name))
+    expected                    = {"inserts": 0, "updates": 0, "skips": 0}
+    seedrows                    = 0
+    
+    print("* Generating {0} CSV rows ...".format(settings["rows"]))
+    
+    with open(seedfn, "w") as seedfh, open(csvfn, "w") as csvfh:
+        for i in range(settings["rows"]):
+            slot                = i % total
+            key                 = ["{0}{1}".format(get_random_value(rnd)[:settings["varchar"] - 1], i) for column in get_key_columns()]
+            values              = [get_random_value(rnd) for column in get_data_columns()]
+            
+            if (slot < inserts):
+                action          = "inserts"
+            elif (slot < inserts + updates):
+                action          = "updates"
+            else:
+                action          = "skips"
+            expected[action]    = expected[action] + 1
+            
+            if (action != "inserts"):
+                seedrow         = key + values
+                if (action == "updates"):
+                    seedrow[settings["keys"]] = get_random_value(rnd)
+                seedfh.write(",".join(seedrow) + "\n")
+                seedrows        = seedrows + 1
+            
+            csvfh.write(",".join('"{0}"'.format(value) for value in key + values) + "\n")
+    
+    return seedfn, csvfn, seedrows, expected
+
+
+# Shaped like conf/example.ini
+def write_ini(db, mode):
+    name, select_settings, update_settings, args = mode
+    ininame                     = "{0}_{1}".format(bench_name, name)
+    columns                     = get_key_columns() + get_data_columns()
+    
+    sections                    = [
+        ("database", [
+            ("host", db["host"]),
+            ("type", "postgresql"),
+            ("name", db["name"]),
+            ("table", bench_name),
+            ("port", db["port"]),
+            ("user", db["user"]),
+            ("pass", db["pass"])
+        ]),
+        ("csv", [
+            ("fields_list", ",".join("\"{0}_csv\"".format(column) for column in columns)),
+            ("delimiter", ","),
+            ("quotechar", '"')
+        ]),
+        ("get_database_data", [
+            ("columns_list", ",".join("\"{0}_varchar\"".format(column) for column in columns)),
+            ("keys_list", ",".join("\"{0}\"".format(column) for column in get_key_columns()))
+        ] + sorted(select_settings.items())),
+        ("update_database_data", [
+            ("columns_list", ",".join("\"{0}\"".format(column) for column in get_data_columns()))
+        ] + sorted(update_settings.items())),
+        ("database_mapping", [("{0}_csv".format(column), column) for column in columns])
+    ]
+    
+    with open("{0}/{1}.ini".format(confpath, ininame), "w") as fh:
+        for section, values in sections:
+            fh.write("[{0}]\n".format(section))
+            for setting, value in values:
+                fh.write("{0:<32}= {1}\n".format(setting, value))
+            fh.write("\n")
+    
+    return ininame
+
+
+def reset_table(connection, seedfn):
+    cursor                      = connection.cursor()
+    columns                     = get_key_columns() + get_data_columns()
+    
+    cursor.execute("drop table if exists {0};".format(bench_name))
+    cursor.execute("create table {0} (id serial primary key, {1});".format(bench_name, ", ".join("{0} varchar".format(column) for column in columns)))
+    
+    with open(seedfn) as fh:
+        cursor.copy_expert("copy {0} ({1}) from stdin with (format csv);".format(bench_name, ", ".join(columns)), fh)
+    
+    cursor.execute("create unique index on {0} ({1});".format(bench_name, ", ".join(get_key_columns())))
+    cursor.execute("analyze {0};".format(bench_name))
+    connection.commit()
+    cursor.close()
+
+
+# Statements counted by the server with pg_stat_statements, if it is
+# installed. The few queries of the benchmark itself are counted too.
+def get_statement_count(connection):
+    cursor                      = connection.cursor()
+    
+    try:
+        cursor.execute("create extension if not exists pg_stat_statements;")
+        cursor.execute("select coalesce(sum(calls), 0) from pg_stat_statements s join pg_database d on d.oid = s.dbid where d.datname = current_database();")
+        count                   = int(cursor.fetchone()[0])
+        connection.commit()
+    except psycopg2.Error:
+        connection.rollback()
+        count                   = None
+    
+    cursor.close()
+    return count
+
+
+def get_table_count(connection):
+    cursor                      = connection.cursor()
+    cursor.execute("select count(*) from {0};".format(bench_name))
+    count                       = cursor.fetchone()[0]
+    connection.commit()
+    cursor.close()
+    
+    return count
+
+
+def run_mode(db, connection, mode, seedfn, csvfn, seedrows, expected):
+    name, select_settings, update_settings, args = mode
+    ininame                     = write_ini(db, mode)
+    
+    reset_table(connection, seedfn)
+    statements                  = get_statement_count(connection)
+    
+    print("* {0} ...".format(name))
+    
+    # Started in the CSV directory - the import adds csv/ in front of
+    # absolute paths
+    reportfn                    = os.path.join(os.path.dirname(csvfn), "{0}.json".format(ininame))
+    command                     = [sys.executable, import_script, os.path.basename(csvfn), "--ini", ininame, "--report", reportfn] + args
+    
+    # wait4() gives the resource usage of this one process
+    with tempfile.TemporaryFile() as errfh:
+        started                 = time.time()
+        process                 = subprocess.Popen(command, cwd=os.path.dirname(csvfn), stdout=subprocess.DEVNULL, stderr=errfh)
+        pid, status, usage      = os.wait4(process.pid, 0)
+        seconds                 = time.time() - started
+        process.returncode      = os.WEXITSTATUS(status)
+        
+        errfh.seek(0)
+        error                   = errfh.read().decode("utf-8", "replace").strip()
+    
+    if (statements != None):
+        statements              = get_statement_count(connection) - statements
+    
+    table_rows                  = get_table_count(connection)
+    
+    # The statistics of the import itself
+    run_report                  = {}
+    if (os.path.exists(reportfn)):
+        with open(reportfn) as fh:
+            run_report          = json.load(fh)
+        os.remove(reportfn)
+    
+    result                      = {
+        "mode"          : name,
+        "args"          : args,
+        "select"        : select_settings,
+        "update"        : update_settings,
+        "exit_code"     : process.returncode,
+        "error"         : error if process.returncode != 0 else None,
+        "seconds"       : round(seconds, 3),
+        "rows_per_sec"  : round(settings["rows"] / seconds, 1),
+        "statements"    : run_report.get("statements_total"),
+        "round_trips"   : run_report.get("round_trips_total"),
+        "server_statements": statements,
+        "run_report"    : run_report,
+        "peak_rss_kb"   : usage.ru_maxrss,     # The main process only
+        "table_rows_ok" : table_rows == seedrows + expected["inserts"]
+    }
+    
+    print("  {0:.3f}s, {1} rows/sec, peak RSS {2} KB{3}".format(seconds, result["rows_per_sec"], usage.ru_maxrss, "" if process.returncode == 0 else ", FAILED: {0}".format(error)))
+    
+    if (not settings["keep"]):
+        os.remove("{0}/{1}.ini".format(confpath, ininame))
+    
+    return result
+
+
+def get_script_version():
+    with open(import_script, "rb") as fh:
+        script_md5              = hashlib.md5(fh.read()).hexdigest()
+    
+    commit                      = None
+    try:
+        commit                  = subprocess.check_output(["git", "-C", execpath, "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    
+    return {"script_md5": script_md5, "git_commit": commit}
+
+
+def write_report(expected, results):
+    report                      = {
+        "created"       : time.strftime("%Y-%m-%d %H:%M:%S"),
+        "version"       : get_script_version(),
+        "python"        : platform.python_version(),
+        "settings"      : {
+            "rows"      : settings["rows"],
+            "columns"   : settings["columns"],
+            "keys"      : settings["keys"],
+            "ratio"     : ":".join(str(share) for share in settings["ratio"]),
+            "varchar"   : settings["varchar"]
+        },
+        "expected"      : expected,
+        "results"       : results
+    }
+    
+    with open(settings["report"], "w") as fh:
+        json.dump(report, fh, indent=4)
+    
+    print()
+    print("REPORT: {0}".format(settings["report"]))
+
+
+
+
+# ========================================================== MAIN BEGIN
+workdir                         = None
+datadir                         = None
+
+try:
+    print()
+    print("***CSV IMPORT-UPDATE BENCHMARK***")
+    print()
+    
+    get_settings()
+    db                          = get_database_settings()
+    workdir                     = tempfile.mkdtemp(prefix="{0}_".format(bench_name))
+    
+    if (settings["start_postgres"]):
+        datadir                 = start_postgres(db, workdir)
+    
+    seedfn, csvfn, seedrows, expected = generate_files(workdir)
+    print("  inserts:{0}, updates:{1}, skips:{2}".format(expected["inserts"], expected["updates"], expected["skips"]))
+    print()
+    
+    connection                  = get_connection(db)
+    results                     = []
+    for mode in bench_modes:
+        if (mode[0] in settings["modes"]):
+            results.append(run_mode(db, connection, mode, seedfn, csvfn, seedrows, expected))
+    
+    cursor                      = connection.cursor()
+    cursor.execute("drop table if exists {0};".format(bench_name))
+    connection.commit()
+    connection.close()
+    
+    write_report(expected, results)
+
+
+except Exception as e:
+    print()
+    print("--------------------[ EXCEPTION")
+    sys.exit("{0} ({1})".format(e, type(e)))
+
+finally:
+    if (datadir != None):
+        stop_postgres(datadir)
+    
+    if (workdir != None and not settings["keep"]):
+        shutil.rmtree(workdir, ignore_errors=True)
+    elif (workdir != None):
+        print("Files kept in: {0}".format(workdir))
@@ -9,21 +9,69 @@ import sys
 import csv
 import os
 import os.path
+import io
+import copy
+import glob
+import bz2
+import gzip
+import lzma
+import dbm
+import zlib
+import mmap
+import pickle
+import hashlib
+import sqlite3
+import json
+import time
+import bisect
+import locale
+import threading
 import pprint
+import shutil
+import signal
+import tempfile
+import asyncio
+import collections
 import configparser
+import multiprocessing
+import concurrent.futures
 
 from io import StringIO
 
 import psycopg2                 # PostgreSQL
+import psycopg2.extras
 
-# ----------------------------------------------
-# Remove the comment '#' from next lines, if you are using any of these
-# databases. Don't forget to install the connector module !!
+try:
+    import zstandard            # Only for .zst files
+except ImportError:
+    zstandard                   = None
+
+try:
+    import inotify_simple       # Only for --watch, which polls without it
+except ImportError:
+    inotify_simple              = None
+
+try:
+    import mysql.connector      # Only for [database].type = mysql
+except ImportError:
+    mysql                       = None
+
+try:
+    import pyodbc               # Only for [database].type = sqlserver
+except ImportError:
+    pyodbc                      = None
+
+try:
+    import cx_Oracle            # Only for [database].type = oracle
+except ImportError:
+    cx_Oracle                   = None
 
-#import mysql.connector          # MySQL
-#import cx_Oracle                # Oracle
-#import pymssql                  # MS SQL Server
-# ----------------------------------------------
+try:
+    import pyarrow              # Only for --diff-file FILE.parquet and compare = vector
+    import pyarrow.parquet
+    import pyarrow.compute
+except ImportError:
+    pyarrow                     = None
 
 
 # WHAT IS THIS:
@@ -33,13 +81,22 @@ import psycopg2                 # PostgreSQL
 
 
 # HELP
-help_string                     = """USAGE: csv_import_update.py [path]<FILENAME>[.csv] [debug|verbose|diff]
+help_string                     = """USAGE: csv_import_update.py [path]<FILENAME>[.csv] [debug|verbose|diff|quiet] [resume] [--workers N] [--parsers N] [--jobs N] [--watch] [--fingerprints verify|rebuild] [--ini NAME] [--report FILE] [--diff-file FILE] [--progress SECONDS]
 
 EXAMPLE:
     ./csv_import_update.py ./mycsv.csv
     ./csv_import_update.py mycsv
     ./csv_import_update.py dir1/dir2/mycsv.csv debug
     ./csv_import_update.py dir1/dir2/mycsv.csv diff
+    ./csv_import_update.py dir1/dir2/mycsv.csv.gz
+    ./csv_import_update.py dir1/incoming/ quiet --jobs 4
+    ./csv_import_update.py "dir1/incoming/partner_*.csv" --ini partner
+    gunzip -c mycsv.csv.gz | ./csv_import_update.py - --ini mycsv
+
+FILENAME may be a .csv.gz, .csv.bz2, .csv.xz or .csv.zst file - it is
+decompressed while reading. "-" reads the CSV from the standard input.
+A directory (all CSV files in it) or a glob pattern imports many files -
+each with its own INI, unless --ini is given.
 
 verbose
     Enables VERBOSE MODE - more messages on screen.
@@ -49,6 +106,42 @@ debug
 diff
     Only displays differences betwen the CSV file and the table values.
     UPDATE and INSERT queries will not be executed.
+quiet
+    No message for every row - only a progress line every 10 seconds
+    (or --progress SECONDS), the errors and the summary.
+resume
+    Continue an import which stopped, from its last checkpoint - see
+    "checkpoint" in README.txt.
+--workers N
+    Import with N parallel processes, each with its own database
+    connection. Rows with the same key always go to the same process.
+--parsers N
+    Read (parse) the CSV file with N parallel processes.
+--jobs N
+    With a directory or a glob pattern: import N CSV files at the same
+    time.
+--watch
+    FILENAME is a directory - import each new CSV file in it as soon as
+    it is complete, then move it to done/ (or failed/). Runs until
+    Ctrl+C.
+--fingerprints verify|rebuild
+    Only with "incremental = yes". Before the import, check the stored
+    fingerprints against the table (verify) or create them all again
+    from the table (rebuild).
+--ini NAME
+    Use conf/NAME.ini. Needed when the CSV is read from the standard
+    input ("-").
+--report FILE
+    At the end write the run statistics (queries and round trips by
+    type, time per phase, rows/sec) to FILE - JSON, or Prometheus
+    textfile format if FILE ends with .prom.
+--diff-file FILE
+    Write every difference between the CSV file and the table to FILE -
+    CSV, or Parquet if FILE ends with .parquet (needs pyarrow). One line
+    for each differing column, with the key, the CSV line number, the
+    database value and the CSV value. Best together with "diff".
+--progress SECONDS
+    Print a progress line every SECONDS seconds.
 
 Quick n dirty CSV importer.
 
@@ -61,10 +154,10 @@ same name as the CSV file, located in conf/ subdirectory
 The script also expects and reads a default INI file: conf/defaults.ini
 
 SUPPORTED DATABASES:
-PostgreSQL, MySQL, Oracle, MS SQL Server
+PostgreSQL, MySQL, Oracle, MS SQL Server, SQLite
 
 TESTED ON:
-!!!PostgreSQL ONLY!!!
+!!!PostgreSQL and SQLite ONLY!!!
 Written in Python 3.5.3
 
 FOR EXAMPLE INI FILE, CHECK conf/example.ini
@@ -83,234 +176,3698 @@ required_database_settings      = ['type', 'host', 'name', 'table', 'user', 'por
 required_csv_settings           = ['fields_list']
 required_select_settings        = ['columns_list', 'keys_list']
 required_update_settings        = ['columns_list']
+supported_id_strategies         = ['max', 'local', 'sequence', 'default']
+id_block_size_default           = 1000
+supported_lookups               = ['row', 'batch', 'snapshot']
+lookup_batch_size_default       = 1000
+snapshot_itersize_default       = 10000
+snapshot_memory_rows_default    = 1000000
+supported_fingerprint_actions   = ['verify', 'rebuild']
+checkpoint_seconds_default      = 30
+
+supported_engines               = ['row', 'copy', 'async', 'upsert']
+upsert_batch_size_default       = 1000
+supported_compares              = ['row', 'vector']
+staging_table                   = "csv_import_staging"
+row_savepoint                   = "csv_import_row"
+sql_issue                       = "sql"
+copy_buffer_rows                = 1000
+read_buffer_size_default        = 1048576
+supported_readers               = ['csv', 'mmap']
+compressed_extensions           = ['.gz', '.bz2', '.xz', '.zst']
+sql_placeholder                 = "%s"            # All SQL is written with it - the backends change it for their driver
 
 cursor                          = None
 connection                      = None
 debug_mode                      = False
 verbose_mode                    = False
 diff_mode                       = False
+quiet_mode                      = False
+resume_mode                     = False
+workers                         = 1
+worker_chunk_rows               = 1000
+parsers                         = 1
+jobs                            = 1
+batch_confs                     = {}            # Parsed INI files of the batch mode: file name -> (mtime, conf)
+watch_mode                      = False
+watch_poll_seconds              = 2             # --watch looks for new files this often
+watch_stopping                  = False         # Set by Ctrl+C or SIGTERM, checked between the files
+connection_pool                 = {}            # Open connections of the batch mode, by database
+fingerprints_action             = None
+report_file                     = None
+diff_file                       = None
+diff_parquet_rows               = 65536         # Rows in memory before they go to the Parquet file
+progress_seconds                = 0
+run_stats                       = None
+run_stats_lock                  = threading.Lock()
+stats_phases                    = ['parse', 'lookup', 'compare', 'write', 'commit']
+stats_buckets                   = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]   # Seconds
+parser_min_bytes                = 1048576       # Smaller files are not split
+parser_scan_bytes               = 16777216      # Block size when looking for record boundaries
+parser_range_bytes              = 16777216      # --parsers splits the file in ranges of about this size
+parser_queue_ranges             = 2             # Parsed ranges waiting for the import, per parser
+async_queue_chunks              = 4             # Chunks waiting between the stages of the 'async' engine
+stdout_buffer_size              = 65536         # Screen output is written in blocks of this size
+quiet_progress_seconds          = 10            # Default --progress in QUIET MODE
 
-application_issues_list         = {}
 csv_file_issue                  = "csv"
+issue_samples                   = 1000          # Application issues of each category kept in memory, the rest go to a file
 
 pp                              = pprint.PrettyPrinter(indent=4)
 
 
 
 
-def debug_print(s):
-    if (diff_mode):
+# The messages are formatted only if they are printed - pass the values
+# as arguments instead of calling .format() on the message
+def debug_print(s, *args):
+    if (diff_mode or not (verbose_mode or debug_mode)):
+        return
+    
+    if (s == ""):
+        print()
+    else:
+        print("DEBUG: {0}".format(s.format(*args) if args else s))
+
+
+def diff_print(s, *args):
+    if (not diff_mode):
+        return
+    print(s.format(*args) if args else s)
+
+
+def regular_print(s, *args):
+    if (not diff_mode):
+        print(s.format(*args) if args else s)
+
+
+# One message per row (inserting, updating, skipping) - not in DIFF MODE
+# and not in QUIET MODE
+def row_print(rowcnt, message, fields, row):
+    if (diff_mode or quiet_mode):
+        return
+    print("[{0}] {1}: {2}".format(rowcnt, message, dict(zip(fields, row))))
+
+
+# Block buffered screen output: one write per stdout_buffer_size bytes
+# instead of one per line. The progress lines and the end of the run
+# flush it.
+def set_stdout_buffer():
+    sys.stdout.flush()
+    sys.stdout                  = open(sys.stdout.fileno(), "w", buffering=stdout_buffer_size, encoding=sys.stdout.encoding, errors=sys.stdout.errors, closefd=False)
+
+
+# Application issues are counted for each category, but only the first
+# issue_samples of each one are kept (and printed at the end). The rest
+# go straight to a text file, so a CSV with millions of bad rows does
+# not fill the memory. Entries are (CSV file name, CSV line, message) -
+# the file name is set in the batch mode only. The message starts with
+# its separator: " text" or "[Col:N] text".
+class ApplicationIssues:
+    def __init__(self):
+        self.counts             = {}
+        self.samples            = {}
+        self.spill_fn           = None
+        self.spill              = None
+    
+    # Goes to the parent process - without the open file
+    def __getstate__(self):
+        self.close()
+        return dict(self.__dict__)
+    
+    def __len__(self):
+        return sum(self.counts.values())
+    
+    def add(self, category, rowcnt, issuemsg, fn=None):
+        self.counts[category]   = self.counts.get(category, 0) + 1
+        
+        if (category not in self.samples):
+            self.samples[category] = []
+        
+        if (len(self.samples[category]) < issue_samples):
+            self.samples[category].append((fn, rowcnt, issuemsg))
+        else:
+            self.write_line(get_issue_line(category, (fn, rowcnt, issuemsg)))
+    
+    def write_line(self, line):
+        if (self.spill == None):
+            if (self.spill_fn == None):
+                fd, self.spill_fn = tempfile.mkstemp(prefix="csv_import_issues_", suffix=".txt")
+                os.close(fd)
+            self.spill          = open(self.spill_fn, "a", encoding="utf-8")
+        
+        self.spill.write(line)
+        self.spill.write("\n")
+    
+    # Issues of a worker or of one file of the batch
+    def merge(self, other, fn=None):
+        for category in other.samples:
+            for entry in other.samples[category]:
+                self.add(category, entry[1], entry[2], fn)
+            
+            # Not kept there either, these are only in its file
+            self.counts[category] = self.counts[category] + other.counts[category] - len(other.samples[category])
+        
+        if (other.spill_fn == None):
+            return
+        
+        other.close()
+        with open(other.spill_fn, encoding="utf-8") as fh:
+            for line in fh:
+                if (fn != None):
+                    line        = "{0} {1}".format(fn, line)
+                self.write_line(line.rstrip("\n"))
+        os.remove(other.spill_fn)
+    
+    def close(self):
+        if (self.spill != None):
+            self.spill.close()
+            self.spill          = None
+
+
+application_issues_list         = ApplicationIssues()
+
+
+def add_application_issue(category, rowcnt, issuemsg):
+    application_issues_list.add(category, rowcnt, issuemsg)
+
+
+def get_issue_line(category, entry):
+    fn, rowcnt, issuemsg        = entry
+    line                        = "[{0}][Ln:{1}]{2}".format(category, rowcnt, issuemsg)
+    
+    if (fn != None):
+        line                    = "{0} {1}".format(fn, line)
+    
+    return line
+
+
+def get_all_application_issues():
+    for category in application_issues_list.samples:
+        for entry in application_issues_list.samples[category]:
+            yield get_issue_line(category, entry)
+
+
+def print_all_application_issues():
+    if (len(application_issues_list) > 0):
+        print()
+        print("LIST OF ALL APPLICATION ISSUES")
+        print("------------------------------")
+    
+    for imsg in get_all_application_issues():
+        print(imsg)
+    
+    application_issues_list.close()
+    for category in application_issues_list.counts:
+        more                    = application_issues_list.counts[category] - len(application_issues_list.samples[category])
+        if (more > 0):
+            print("... and {0} more [{1}] issues in {2}".format(more, category, application_issues_list.spill_fn))
+
+
+def get_database_connection(conf):
+    db                          = conf["db"]["type"]
+    dbconf                      = conf["db"][db]
+    backend                     = conf["backend"]
+    
+    print("* Connecting to database '{0}' (*{1}* {2}) ...".format(dbconf["name"], db, backend.get_address(dbconf)))
+    print()
+    
+    return backend.connect(dbconf)
+
+
+# ---------- Database backends
+# Everything which is different for each database. The rest of the
+# script writes its SQL with "%s" placeholders and ";" at the end, like
+# PostgreSQL wants it, and the backend cursor changes it for the other
+# databases. Each backend has its own fastest way to write a batch of
+# rows ("write_batch_size"): a multi-row VALUES list for PostgreSQL and
+# executemany() of the database's merge statement for all the others.
+
+class DatabaseBackend:
+    name                        = None
+    module                      = None      # The connector, None if not installed
+    module_name                 = None
+    required_settings           = required_database_settings
+    row_values                  = True      # Supports "(a, b) in ((1, 2), (3, 4))"
+    lock_table                  = None      # For id_strategy = local
+    savepoint_queries           = ["savepoint {0};"]
+    release_queries             = ["release savepoint {0};", "savepoint {0};"]
+    rollback_queries            = ["rollback to savepoint {0};"]
+    
+    def __init__(self):
+        self.queries            = {}        # SQL of the script -> SQL for the driver
+    
+    def get_address(self, dbconf):
+        return "{0}:{1}".format(dbconf["host"], dbconf["port"])
+    
+    def connect(self, dbconf):
+        if (self.module == None):
+            raise Exception("Database type '{0}' needs the Python module '{1}'. Please install it.".format(self.name, self.module_name))
+        
+        return BackendConnection(self, self.get_connection(dbconf))
+    
+    def get_connection(self, dbconf):
+        raise Exception("Database type '{0}' can not connect.".format(self.name))
+    
+    def get_cursor(self, dbconnection):
+        return dbconnection.cursor()
+    
+    def get_sql(self, sql):
+        if (sql not in self.queries):
+            self.queries[sql]   = self.translate(sql)
+        
+        return self.queries[sql]
+    
+    def translate(self, sql):
+        return sql
+    
+    def set_savepoint(self, dbcursor):
+        for sql in self.savepoint_queries:
+            dbcursor.execute(sql.format(row_savepoint))
+    
+    # The query (if any), then release the savepoint and set the next one
+    def execute_savepoint(self, dbcursor, sql, params):
+        if (sql != ""):
+            dbcursor.execute(sql, params)
+        
+        for query in self.release_queries:
+            dbcursor.execute(query.format(row_savepoint))
+    
+    def rollback_savepoint(self, dbcursor):
+        for sql in self.rollback_queries:
+            dbcursor.execute(sql.format(row_savepoint))
+    
+    def get_batch_write(self, conf, action, rows):
+        if (action == "updates"):
+            return get_batch_update_params(conf, rows)
+        
+        sql, values             = get_batch_merge_query(conf, rows)
+        return sql, None, values
+    
+    def execute_batch_write(self, dbcursor, sql, template, values):
+        dbcursor.executemany(sql, values)
+    
+    def get_merge_query(self, table, columns, keys, set_columns):
+        raise Exception("Database type '{0}' has no batch writes.".format(self.name))
+
+
+class PostgresqlBackend(DatabaseBackend):
+    name                        = "postgresql"
+    module                      = psycopg2
+    module_name                 = "psycopg2"
+    lock_table                  = "lock table {0} in share row exclusive mode;"
+    
+    def connect(self, dbconf):
+        return psycopg2.connect(host=dbconf["host"], port=dbconf["port"], database=dbconf["name"], user=dbconf["user"], password=dbconf["pass"], connection_factory=InstrumentedConnection)
+    
+    # The query, releasing the savepoint and setting the next one go in
+    # the same round trip
+    def execute_savepoint(self, dbcursor, sql, params):
+        dbcursor.execute("{1} release savepoint {0}; savepoint {0};".format(row_savepoint, sql).lstrip(), params)
+    
+    def get_batch_write(self, conf, action, rows):
+        if (action == "inserts"):
+            return get_batch_insert_query(conf, rows)
+        
+        return get_batch_update_query(conf, rows)
+    
+    def execute_batch_write(self, dbcursor, sql, template, values):
+        psycopg2.extras.execute_values(dbcursor, sql, values, template=template, page_size=len(values))
+
+
+# LOAD DATA LOCAL INFILE needs a file and a server setting, so the rows
+# go with executemany(), which the connector sends as one multi-row
+# INSERT ... ON DUPLICATE KEY UPDATE
+class MysqlBackend(DatabaseBackend):
+    name                        = "mysql"
+    module                      = mysql
+    module_name                 = "mysql.connector"
+    
+    def get_connection(self, dbconf):
+        return mysql.connector.connect(host=dbconf["host"], port=dbconf["port"], database=dbconf["name"], user=dbconf["user"], password=dbconf["pass"])
+    
+    def get_cursor(self, dbconnection):
+        return dbconnection.cursor(buffered=True)
+    
+    def get_merge_query(self, table, columns, keys, set_columns):
+        set_clause              = []
+        for column in set_columns:
+            set_clause.append("{0} = values({0})".format(column))
+        
+        return "insert into {0} ({1}) values ({2}) on duplicate key update {3};".format(table, ', '.join(columns), get_placeholders(len(columns)), ', '.join(set_clause))
+
+
+# fast_executemany sends all the rows of a batch in one bulk operation
+class SqlserverBackend(DatabaseBackend):
+    name                        = "sqlserver"
+    module                      = pyodbc
+    module_name                 = "pyodbc"
+    row_values                  = False
+    savepoint_queries           = ["save transaction {0};"]
+    release_queries             = ["save transaction {0};"]
+    rollback_queries            = ["rollback transaction {0};"]
+    
+    def get_connection(self, dbconf):
+        driver                  = dbconf.get("driver", "ODBC Driver 18 for SQL Server")
+        return pyodbc.connect("DRIVER={{{0}}};SERVER={1},{2};DATABASE={3};UID={4};PWD={5}".format(driver, dbconf["host"], dbconf["port"], dbconf["name"], dbconf["user"], dbconf["pass"]))
+    
+    def get_cursor(self, dbconnection):
+        dbcursor                = dbconnection.cursor()
+        dbcursor.fast_executemany = True
+        return dbcursor
+    
+    def translate(self, sql):
+        return sql.replace(sql_placeholder, "?")
+    
+    def get_merge_query(self, table, columns, keys, set_columns):
+        return get_merge_using_query(table, columns, keys, set_columns, "select {0}", "merge into {0} with (holdlock) as t using ({1}) as v on {2} when matched then update set {3} when not matched then insert ({4}) values ({5});")
+
+
+# executemany() binds all the rows of a batch as arrays, so the MERGE is
+# executed once for all of them
+class OracleBackend(DatabaseBackend):
+    name                        = "oracle"
+    module                      = cx_Oracle
+    module_name                 = "cx_Oracle"
+    lock_table                  = "lock table {0} in share row exclusive mode;"
+    release_queries             = ["savepoint {0};"]
+    
+    def get_connection(self, dbconf):
+        return cx_Oracle.connect(user=dbconf["user"], password=dbconf["pass"], dsn=cx_Oracle.makedsn(dbconf["host"], dbconf["port"], service_name=dbconf["name"]))
+    
+    # Numbered placeholders and no ";" at the end
+    def translate(self, sql):
+        parts                   = sql.rstrip().rstrip(";").split(sql_placeholder)
+        translated              = parts[0]
+        for i in range(1, len(parts)):
+            translated          = "{0}:{1}{2}".format(translated, i, parts[i])
+        
+        return translated
+    
+    def get_merge_query(self, table, columns, keys, set_columns):
+        return get_merge_using_query(table, columns, keys, set_columns, "select {0} from dual", "merge into {0} t using ({1}) v on ({2}) when matched then update set {3} when not matched then insert ({4}) values ({5});")
+
+
+# Here [database].name is the database file. The CSV import is then
+# fully local - nothing else is needed.
+class SqliteBackend(DatabaseBackend):
+    name                        = "sqlite"
+    module                      = sqlite3
+    module_name                 = "sqlite3"
+    required_settings           = ['type', 'name', 'table']
+    
+    def get_address(self, dbconf):
+        return "local file"
+    
+    def get_connection(self, dbconf):
+        return sqlite3.connect(dbconf["name"], timeout=float(dbconf.get("timeout", 5)))
+    
+    def translate(self, sql):
+        return sql.replace(sql_placeholder, "?")
+    
+    # A savepoint outside of a transaction starts its own one, which its
+    # release would commit
+    def set_savepoint(self, dbcursor):
+        if (not dbcursor.connection.in_transaction):
+            dbcursor.execute("begin;")
+        
+        DatabaseBackend.set_savepoint(self, dbcursor)
+    
+    # Needs a primary key or a unique index on exactly "keys_list"
+    def get_merge_query(self, table, columns, keys, set_columns):
+        set_clause              = []
+        for column in set_columns:
+            set_clause.append("{0} = excluded.{0}".format(column))
+        
+        return "insert into {0} ({1}) values ({2}) on conflict ({3}) do update set {4};".format(table, ', '.join(columns), get_placeholders(len(columns)), ', '.join(keys), ', '.join(set_clause))
+
+
+database_backends               = {
+    "postgresql"    : PostgresqlBackend,
+    "mysql"         : MysqlBackend,
+    "sqlserver"     : SqlserverBackend,
+    "oracle"        : OracleBackend,
+    "sqlite"        : SqliteBackend
+}
+
+
+def get_database_backend(db):
+    if (db not in database_backends):
+        raise Exception("Unknown database type: {0}. Supported: {1}".format(db, ', '.join(database_backends.keys())))
+    
+    return database_backends[db]()
+
+
+# MERGE ... USING (one row of values) for SQL Server and Oracle
+def get_merge_using_query(table, columns, keys, set_columns, values_row, merge):
+    values                      = []
+    for column in columns:
+        values.append("{0} as {1}".format(sql_placeholder, column))
+    
+    join                        = []
+    for column in keys:
+        join.append("t.{0} = v.{0}".format(column))
+    
+    set_clause                  = []
+    for column in set_columns:
+        set_clause.append("t.{0} = v.{0}".format(column))
+    
+    insert_values               = []
+    for column in columns:
+        insert_values.append("v.{0}".format(column))
+    
+    return merge.format(table, values_row.format(', '.join(values)), ' and '.join(join), ', '.join(set_clause), ', '.join(columns), ', '.join(insert_values))
+
+
+# The connections of the other databases are wrapped, so their queries
+# are counted like with InstrumentedConnection and changed for their
+# driver
+class BackendConnection:
+    def __init__(self, backend, dbconnection):
+        self.backend            = backend
+        self.dbconnection       = dbconnection
+        self.closed             = False
+    
+    def __getattr__(self, name):
+        return getattr(self.dbconnection, name)
+    
+    def cursor(self):
+        return BackendCursor(self, self.backend.get_cursor(self.dbconnection))
+    
+    def commit(self):
+        started                 = time.perf_counter()
+        try:
+            return self.dbconnection.commit()
+        finally:
+            record_statement("commit", time.perf_counter() - started, "commit")
+    
+    def rollback(self):
+        started                 = time.perf_counter()
+        try:
+            return self.dbconnection.rollback()
+        finally:
+            record_statement("rollback", time.perf_counter() - started, "rollback")
+    
+    # Like with psycopg2, closing twice is not an error
+    def close(self):
+        if (not self.closed):
+            self.dbconnection.close()
+        self.closed             = True
+
+
+class BackendCursor:
+    def __init__(self, connection, dbcursor):
+        self.connection         = connection
+        self.dbcursor           = dbcursor
+    
+    def __getattr__(self, name):
+        return getattr(self.dbcursor, name)
+    
+    def __iter__(self):
+        return iter(self.dbcursor)
+    
+    def execute(self, sql, params=None):
+        started                 = time.perf_counter()
+        try:
+            if (params == None):
+                return self.dbcursor.execute(self.connection.backend.get_sql(sql))
+            return self.dbcursor.execute(self.connection.backend.get_sql(sql), params)
+        finally:
+            record_statement(sql, time.perf_counter() - started)
+    
+    def close(self):
+        if (not self.connection.closed):
+            self.dbcursor.close()
+    
+    def executemany(self, sql, values):
+        started                 = time.perf_counter()
+        try:
+            return self.dbcursor.executemany(self.connection.backend.get_sql(sql), values)
+        finally:
+            record_statement(sql, time.perf_counter() - started)
+
+
+# ---------- Run statistics
+# Every query sent to the database is one round trip. One round trip may
+# carry more statements (query + savepoint), which are counted too.
+
+def set_run_stats():
+    global run_stats
+    
+    phases                      = {}
+    for phase in stats_phases:
+        phases[phase]           = {"count": 0, "seconds": 0.0, "buckets": [0] * (len(stats_buckets) + 1)}
+    
+    run_stats                   = {
+        "started"       : time.time(),
+        "round_trips"   : {},
+        "statements"    : {},
+        "phases"        : phases,
+        "prepared"      : {},
+        "next_progress" : time.time() + progress_seconds
+    }
+
+
+def observe_phase(phase, seconds):
+    stats                       = run_stats["phases"][phase]
+    stats["count"]              = stats["count"] + 1
+    stats["seconds"]            = stats["seconds"] + seconds
+    stats["buckets"][bisect.bisect_left(stats_buckets, seconds)] += 1
+
+
+def get_statement_kind(sql):
+    if (isinstance(sql, bytes)):
+        sql                     = sql[:200].decode("utf-8", "replace")
+    sql                         = sql.lstrip().lower()
+    
+    if (sql.startswith("select") and ("nextval(" in sql or "coalesce(max(" in sql)):
+        return "next_id"
+    
+    # Prepared statements are executed by name
+    match                       = re.match(r'prepare (\w+) as (.*)', sql, re.S)
+    if (match):
+        run_stats["prepared"][match.group(1)] = get_statement_kind(match.group(2))
+        return "prepare"
+    
+    match                       = re.match(r'execute (\w+)', sql)
+    if (match):
+        return run_stats["prepared"].get(match.group(1), "other")
+    
+    word                        = sql.split(None, 1)[0] if len(sql) > 0 else ""
+    if (word in ["select", "insert", "update", "lock", "copy"]):
+        return word
+    
+    if (word == "merge"):
+        return "insert"
+    
+    if (word in ["savepoint", "release", "rollback", "save", "begin"]):
+        return "savepoint"
+    
+    return "other"
+
+
+def get_statement_phase(kind):
+    if (kind == "select"):
+        return "lookup"
+    
+    if (kind == "commit"):
+        return "commit"
+    
+    return "write"
+
+
+def record_statement(sql, seconds, kind=None):
+    if (kind == None):
+        kind                    = get_statement_kind(sql)
+    
+    statements                  = 1
+    if (isinstance(sql, str) and sql.count(";") > 1):
+        statements              = sql.count(";")
+    
+    with run_stats_lock:
+        run_stats["round_trips"][kind] = run_stats["round_trips"].get(kind, 0) + 1
+        run_stats["statements"][kind] = run_stats["statements"].get(kind, 0) + statements
+        observe_phase(get_statement_phase(kind), seconds)
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    def execute(self, sql, params=None):
+        started                 = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            record_statement(sql, time.perf_counter() - started)
+    
+    def copy_expert(self, sql, file, size=8192):
+        started                 = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record_statement(sql, time.perf_counter() - started, "copy")
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault("cursor_factory", InstrumentedCursor)
+        return super().cursor(*args, **kwargs)
+    
+    def commit(self):
+        started                 = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            record_statement("commit", time.perf_counter() - started, "commit")
+    
+    def rollback(self):
+        started                 = time.perf_counter()
+        try:
+            return super().rollback()
+        finally:
+            record_statement("rollback", time.perf_counter() - started, "rollback")
+
+
+# Statistics of a worker process, added to the ones of this process
+def merge_run_stats(stats):
+    for counter in ["round_trips", "statements"]:
+        for kind in stats[counter]:
+            run_stats[counter][kind] = run_stats[counter].get(kind, 0) + stats[counter][kind]
+    
+    for phase in stats_phases:
+        merged                  = run_stats["phases"][phase]
+        other                   = stats["phases"][phase]
+        merged["count"]         = merged["count"] + other["count"]
+        merged["seconds"]       = merged["seconds"] + other["seconds"]
+        for i in range(len(merged["buckets"])):
+            merged["buckets"][i]= merged["buckets"][i] + other["buckets"][i]
+
+
+def print_progress(rowcnt):
+    now                         = time.time()
+    if (now < run_stats["next_progress"]):
         return
+    
+    run_stats["next_progress"]  = now + progress_seconds
+    seconds                     = now - run_stats["started"]
+    
+    print("[PROGRESS] rows:{0}, rows/sec:{1:.1f}, round trips:{2}, database seconds:{3:.1f}".format(rowcnt, rowcnt / max(seconds, 0.001), sum(run_stats["round_trips"].values()), run_stats["phases"]["lookup"]["seconds"] + run_stats["phases"]["write"]["seconds"] + run_stats["phases"]["commit"]["seconds"]))
+    sys.stdout.flush()
+
+
+def get_run_report(fn, summary):
+    seconds                     = time.time() - run_stats["started"]
+    phases                      = {}
+    
+    for phase in stats_phases:
+        stats                   = run_stats["phases"][phase]
+        buckets                 = {}
+        cumulative              = 0
+        for i in range(len(stats_buckets)):
+            cumulative          = cumulative + stats["buckets"][i]
+            buckets[str(stats_buckets[i])] = cumulative
+        buckets["+Inf"]         = stats["count"]
+        
+        phases[phase]           = {"count": stats["count"], "seconds": round(stats["seconds"], 6), "buckets": buckets}
+    
+    report                      = {
+        "file"              : fn,
+        "started"           : time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run_stats["started"])),
+        "seconds"           : round(seconds, 3),
+        "rows_per_sec"      : round(summary["total"] / max(seconds, 0.001), 1),
+        "summary"           : summary,
+        "round_trips"       : run_stats["round_trips"],
+        "round_trips_total" : sum(run_stats["round_trips"].values()),
+        "statements"        : run_stats["statements"],
+        "statements_total"  : sum(run_stats["statements"].values()),
+        "issues"            : application_issues_list.counts,
+        "phases"            : phases
+    }
+    
+    return report
+
+
+def get_prometheus_report(report):
+    lines                       = []
+    
+    lines.append("# TYPE csv_import_duration_seconds gauge")
+    lines.append("csv_import_duration_seconds {0}".format(report["seconds"]))
+    lines.append("# TYPE csv_import_rows_per_second gauge")
+    lines.append("csv_import_rows_per_second {0}".format(report["rows_per_sec"]))
+    
+    lines.append("# TYPE csv_import_rows gauge")
+    for action in sorted(report["summary"].keys()):
+        lines.append("csv_import_rows{{action=\"{0}\"}} {1}".format(action, report["summary"][action]))
+    
+    lines.append("# TYPE csv_import_issues gauge")
+    for category in sorted(report["issues"].keys()):
+        lines.append("csv_import_issues{{category=\"{0}\"}} {1}".format(category, report["issues"][category]))
+    
+    for counter in ["round_trips", "statements"]:
+        lines.append("# TYPE csv_import_{0} gauge".format(counter))
+        for kind in sorted(report[counter].keys()):
+            lines.append("csv_import_{0}{{kind=\"{1}\"}} {2}".format(counter, kind, report[counter][kind]))
+    
+    lines.append("# TYPE csv_import_phase_seconds histogram")
+    for phase in stats_phases:
+        stats                   = report["phases"][phase]
+        for le in stats["buckets"]:
+            lines.append("csv_import_phase_seconds_bucket{{phase=\"{0}\",le=\"{1}\"}} {2}".format(phase, le, stats["buckets"][le]))
+        lines.append("csv_import_phase_seconds_sum{{phase=\"{0}\"}} {1}".format(phase, stats["seconds"]))
+        lines.append("csv_import_phase_seconds_count{{phase=\"{0}\"}} {1}".format(phase, stats["count"]))
+    
+    return "\n".join(lines) + "\n"
+
+
+def write_run_report(fn, summary):
+    report                      = get_run_report(fn, summary)
+    
+    # Written next to the final file and then renamed, so a textfile
+    # collector never reads half of it
+    tmpfn                       = "{0}.tmp".format(report_file)
+    with open(tmpfn, "w") as fh:
+        if (report_file.endswith(".prom")):
+            fh.write(get_prometheus_report(report))
+        else:
+            json.dump(report, fh, indent=4)
+    os.replace(tmpfn, report_file)
+    
+    print("REPORT: {0}".format(report_file))
+
+
+# Any key name ending in "_list" will be resolved as a CSV value and returned as list.
+# Any other value will be returned as is.
+def get_ini_value(name, sval):
+    match                       = re.search(r'_list$', name)
+    if not match:
+        return sval.strip() # If not a list, return as is
+    
+    fh                          = StringIO(sval)
+    reader                      = csv.reader(fh, delimiter=',', quotechar='"') # INI values format
+    l                           = list(reader)
+    result_list                 = []
+    
+    # Trimming spaces
+    for val in l[0]:
+        result_list.append(val.strip())
+    
+    return result_list # l[0] # We need just the first element
+
+
+def get_ini_section(sdict):
+    for key in sdict:
+        sdict[key]              = get_ini_value(key, sdict[key])
+    
+    return sdict
+
+
+def check_csv_row(conf, rowcnt, csvrow):
+    debug_print("csv {0}> {1}", rowcnt, csvrow)
+    
+    if (conf["row_plan"]["fields_count"] != len(csvrow)):
+        raise Exception("CSV Line: {0}; Number of fields mismatch. Expected {1}, got {2}. Invalid CSV file.".format(rowcnt, conf["row_plan"]["fields_count"], len(csvrow)))
+
+
+def strip_csv_row(csvrow):
+    return [col.strip() for col in csvrow] # Trim spaces
+
+
+# Rows of the 'mmap' reader are already trimmed
+def get_csv_rows(conf, reader, stripped=False, rowcnt=0):
+    started                     = time.perf_counter()
+    
+    for csvrow in reader:
+        rowcnt                  = rowcnt + 1
+        conf["current_csv_line"]= rowcnt
+        
+        check_csv_row(conf, rowcnt, csvrow)
+        
+        if (not stripped):
+            csvrow              = strip_csv_row(csvrow)
+        
+        observe_phase("parse", time.perf_counter() - started)
+        if (progress_seconds > 0):
+            print_progress(rowcnt)
+        
+        yield rowcnt, csvrow
+        started                 = time.perf_counter()
+
+
+def get_read_buffer_size(conf):
+    if ("read_buffer_size" not in conf["csv"]):
+        return read_buffer_size_default
+    
+    buffer_size                 = int(conf["csv"]["read_buffer_size"])
+    if (buffer_size < 1):
+        raise Exception("Invalid [csv].read_buffer_size: {0}".format(buffer_size))
+    
+    return buffer_size
+
+
+def get_compressed_extension(fn):
+    for extension in compressed_extensions:
+        if (fn.lower().endswith(extension)):
+            return extension
+    
+    return None
+
+
+# Plain, compressed or standard input - always read as a stream, so
+# nothing is decompressed to the disk first
+def open_csv_file(conf, fn):
+    buffer_size                 = get_read_buffer_size(conf)
+    extension                   = get_compressed_extension(fn)
+    
+    if (fn == "-"):
+        return open(sys.stdin.fileno(), buffering=buffer_size, closefd=False)
+    
+    if (extension == None):
+        return open(fn, buffering=buffer_size)
+    
+    if (extension == ".gz"):
+        rawfh                   = gzip.GzipFile(fn, "rb")
+    elif (extension == ".bz2"):
+        rawfh                   = bz2.BZ2File(fn, "rb")
+    elif (extension == ".xz"):
+        rawfh                   = lzma.LZMAFile(fn, "rb")
+    else:
+        if (zstandard == None):
+            raise Exception("Reading .zst files needs the 'zstandard' module: pip install zstandard")
+        rawfh                   = zstandard.ZstdDecompressor().stream_reader(open(fn, "rb"))
+    
+    return io.TextIOWrapper(io.BufferedReader(rawfh, buffer_size))
+
+
+def get_csv_reader(conf):
+    reader                      = "csv"
+    if ("reader" in conf["csv"]):
+        reader                  = conf["csv"]["reader"].lower()
+    
+    if (reader not in supported_readers):
+        raise Exception("Unknown [csv].reader: {0}. Supported: {1}".format(reader, ', '.join(supported_readers)))
+    
+    return reader
+
+
+def get_csv_file_rows(conf, fn, fh):
+    reader                      = get_csv_reader(conf)
+    
+    # Both need to seek in the file
+    if ((parsers > 1 or reader == "mmap") and (fn == "-" or get_compressed_extension(fn) != None)):
+        raise Exception("--parsers and [csv].reader = mmap can not be used with a compressed file or the standard input.")
+    
+    if (parsers > 1):
+        return get_parallel_csv_rows(conf, fn)
+    
+    # With checkpoints the byte offset after each row is kept
+    rowcnt                      = 0
+    position                    = None
+    if (conf["checkpoint"] != None):
+        rowcnt                  = conf["checkpoint"]["line"]
+        position                = conf["checkpoint"]["position"]
+    
+    if (reader == "mmap"):
+        return get_csv_rows(conf, get_mmap_file_records(conf, fh, position), stripped=True, rowcnt=rowcnt)
+    
+    if (position != None):
+        fh                      = get_checkpoint_lines(fn, fh, position)
+    
+    reader                      = csv.reader(fh, delimiter=conf["csv"]["delimiter"], quotechar=conf["csv"]["quotechar"])
+    return get_csv_rows(conf, reader, rowcnt=rowcnt)
+
+
+def get_mmap_file_records(conf, fh, position=None):
+    size                        = os.fstat(fh.fileno()).st_size
+    if (size == 0):
+        return                  # An empty file can not be mapped
+    
+    start                       = 0
+    if (position != None):
+        start                   = position[0]
+    
+    with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for csvrow in get_mmap_records(conf, mm, start, size, locale.getpreferredencoding(False), position):
+            yield csvrow
+
+
+# Records straight from the mapped file. Only the CSV fields which are
+# in [database_mapping] are decoded and trimmed - the others are left
+# as empty strings, so the row still has all "fields_list" positions.
+# Records with a quotechar go through the csv module. position[0] is
+# the offset of the next record.
+def get_mmap_records(conf, mm, start, end, encoding, position=None):
+    delimiter                   = conf["csv"]["delimiter"].encode(encoding)
+    quote                       = conf["csv"]["quotechar"].encode(encoding)
+    fields_count                = conf["row_plan"]["fields_count"]
+    used_indexes                = conf["row_plan"]["used_indexes"]
+    maxsplit                    = -1
+    if (len(used_indexes) > 0):
+        maxsplit                = used_indexes[-1] + 1
+    
+    pos                         = start
+    while (pos < end):
+        nl                      = mm.find(b"\n", pos, end)
+        if (nl < 0):
+            nl                  = end
+        record                  = mm[pos:nl]
+        
+        # A newline inside quotes is not the end of the record
+        if (quote in record):
+            while (record.count(quote) % 2 == 1 and nl < end):
+                nl              = mm.find(b"\n", nl + 1, end)
+                if (nl < 0):
+                    nl          = end
+                record          = mm[pos:nl]
+            
+            pos                 = nl + 1
+            if (position != None):
+                position[0]     = pos
+            lines               = record.decode(encoding).splitlines(True)
+            for csvrow in csv.reader(lines, delimiter=conf["csv"]["delimiter"], quotechar=conf["csv"]["quotechar"]):
+                yield get_used_fields(conf, csvrow)
+            continue
+        
+        pos                     = nl + 1
+        if (position != None):
+            position[0]         = pos
+        if (record.endswith(b"\r")):
+            record              = record[:-1]
+        
+        if (len(record) == 0):
+            yield []            # Same as the csv module
+            continue
+        
+        # Wrong number of fields - check_csv_row() will stop on it
+        if (record.count(delimiter) + 1 != fields_count):
+            yield record.decode(encoding).split(conf["csv"]["delimiter"])
+            continue
+        
+        fields                  = record.split(delimiter, maxsplit)
+        csvrow                  = [''] * fields_count
+        for index in used_indexes:
+            csvrow[index]       = fields[index].decode(encoding).strip()
+        
+        yield csvrow
+
+
+def get_used_fields(conf, csvrow):
+    if (len(csvrow) != conf["row_plan"]["fields_count"]):
+        return csvrow
+    
+    row                         = [''] * len(csvrow)
+    for index in conf["row_plan"]["used_indexes"]:
+        row[index]              = csvrow[index].strip()
+    
+    return row
+
+
+# Splits the file in byte ranges, each starting at the beginning of a
+# record. A newline is a record boundary only if it is not inside quotes,
+# so the quotechars before it are counted - an even count means outside.
+def get_csv_ranges(conf, fn, parts):
+    size                        = os.path.getsize(fn)
+    if (parts < 2 or size < parts * parser_min_bytes):
+        return [(0, size)]
+    
+    quote                       = conf["csv"]["quotechar"].encode("utf-8")
+    targets                     = []
+    for i in range(1, parts):
+        targets.append(size * i // parts)
+    
+    bounds                      = [0]
+    blockpos                    = 0
+    parity                      = 0
+    
+    with open(fn, "rb") as fh:
+        while (len(targets) > 0):
+            block               = fh.read(parser_scan_bytes)
+            if (len(block) == 0):
+                break
+            
+            searchfrom          = 0
+            counted             = 0     # Quotes in block[0:counted_to]
+            counted_to          = 0
+            
+            while (len(targets) > 0 and targets[0] - blockpos < len(block)):
+                nl              = block.find(b"\n", max(targets[0] - blockpos, searchfrom))
+                if (nl < 0):
+                    break       # Continue in the next block
+                
+                counted         = counted + block.count(quote, counted_to, nl)
+                counted_to      = nl
+                searchfrom      = nl + 1
+                
+                if ((parity + counted) % 2 == 0):
+                    if (blockpos + nl + 1 < size):
+                        bounds.append(blockpos + nl + 1)
+                    targets.pop(0)
+            
+            parity              = (parity + counted + block.count(quote, counted_to)) % 2
+            blockpos            = blockpos + len(block)
+    
+    ranges                      = []
+    bounds.append(size)
+    for i in range(len(bounds) - 1):
+        if (bounds[i] < bounds[i + 1]):
+            ranges.append((bounds[i], bounds[i + 1]))
+    
+    return ranges
+
+
+def get_range_lines(fh, end, encoding):
+    pos                         = fh.tell()
+    
+    for line in fh:
+        if (pos >= end):
+            return
+        pos                     = pos + len(line)
+        yield line.decode(encoding)
+
+
+def parse_csv_range(conf, fn, start, end):
+    rows                        = []
+    
+    with open(fn, "rb") as fh:
+        encoding                = locale.getpreferredencoding(False)
+        stripped                = get_csv_reader(conf) == "mmap"
+        
+        if (stripped):
+            mm                  = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            reader              = get_mmap_records(conf, mm, start, end, encoding)
+        else:
+            fh.seek(start)
+            lines               = get_range_lines(fh, end, encoding)
+            reader              = csv.reader(lines, delimiter=conf["csv"]["delimiter"], quotechar=conf["csv"]["quotechar"])
+        
+        for csvrow in reader:
+            if (not stripped):
+                csvrow          = strip_csv_row(csvrow)
+            rows.append(csvrow)
+    
+    return rows
+
+
+# One parser process: every parser_count-th range, starting with its own
+# number. Each range goes to the queue as a whole.
+def parse_csv_ranges(conf, fn, ranges, rowqueue):
+    # Ctrl+C stops the import (in --watch after the file), not the parsers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    
+    for start, end in ranges:
+        try:
+            rows                = parse_csv_range(conf, fn, start, end)
+        except Exception as e:
+            rowqueue.put("[PARSER {0}-{1}] {2}".format(start, end, e))
+            return
+        
+        rowqueue.put(rows)
+
+
+# The file is split in many small ranges and the parsers take turns, so
+# all of them stay busy. The ranges are read here one after another, so
+# the line numbers are the same as in get_csv_rows(). A parser can be
+# only parser_queue_ranges ranges ahead, so a slow import does not fill
+# the memory.
+def get_parallel_csv_rows(conf, fn):
+    parts                       = max(parsers, os.path.getsize(fn) // parser_range_bytes)
+    ranges                      = get_csv_ranges(conf, fn, parts)
+    parser_count                = min(parsers, len(ranges))
+    debug_print("CSV byte ranges: {0}", len(ranges))
+    
+    context                     = multiprocessing.get_context("fork")
+    rowqueues                   = []
+    processes                   = []
+    
+    for parser_no in range(parser_count):
+        rowqueue                = context.Queue(maxsize=parser_queue_ranges)
+        process                 = context.Process(target=parse_csv_ranges, args=(conf, fn, ranges[parser_no::parser_count], rowqueue))
+        process.daemon          = True
+        process.start()
+        rowqueues.append(rowqueue)
+        processes.append(process)
+    
+    rowcnt                      = 0
+    try:
+        for range_no in range(len(ranges)):
+            started             = time.perf_counter()
+            rows                = rowqueues[range_no % parser_count].get()
+            if (isinstance(rows, str)):
+                raise Exception(rows)
+            
+            # Time spent waiting for the parsers
+            observe_phase("parse", time.perf_counter() - started)
+            
+            for csvrow in rows:
+                rowcnt          = rowcnt + 1
+                conf["current_csv_line"] = rowcnt
+                
+                check_csv_row(conf, rowcnt, csvrow)
+                if (progress_seconds > 0):
+                    print_progress(rowcnt)
+                
+                yield rowcnt, csvrow
+    finally:
+        # After an error (or when the rows are not read to the end) the
+        # parsers still running are not needed any more
+        for process in processes:
+            if (process.is_alive()):
+                process.terminate()
+            process.join()
+
+
+def get_csv_chunks(conf, rows, chunk_size):
+    chunk                       = []
+    
+    for rowcnt, csvrow in rows:
+        chunk.append((rowcnt, csvrow))
+        
+        if (len(chunk) >= chunk_size):
+            yield chunk
+            chunk               = []
+    
+    if (len(chunk) > 0):
+        yield chunk
+
+
+def get_lookup_mode(conf):
+    mode                        = "row"
+    if ("lookup_batch_size" in conf["select"]):
+        mode                    = "batch"
+    if ("lookup" in conf["select"]):
+        mode                    = conf["select"]["lookup"].lower()
+    
+    if (mode not in supported_lookups):
+        raise Exception("Unknown [get_database_data].lookup: {0}. Supported: {1}".format(mode, ', '.join(supported_lookups)))
+    
+    if (mode == "row"):
+        return mode
+    
+    for column in conf["select"]["keys_list"]:
+        if (column not in conf["column_types"]):
+            raise Exception("Key column '{0}' must also be in [get_database_data].columns_list to use lookup '{1}'.".format(column, mode))
+    
+    # A custom SELECT can only be executed row by row
+    if ("select" in conf["select"]):
+        return "row"
+    
+    for column in conf["select"]["keys_list"]:
+        check_text_key(conf, column, "lookup '{0}'".format(mode))
+    
+    if (mode == "batch" and len(conf["select"]["keys_list"]) > 1 and not conf["backend"].row_values):
+        raise Exception("[get_database_data].lookup = batch with more than one key column is not supported on {0}.".format(conf["db"]["type"]))
+    
+    if (mode == "snapshot" and conf["db"]["type"] != "postgresql"):
+        raise Exception("[get_database_data].lookup = snapshot is supported on PostgreSQL only.")
+    
+    return mode
+
+
+# The database rows found by a batch lookup (or a snapshot) are matched
+# with the CSV rows by the text of their keys. The database compares
+# typed values, so the integer 7 is found for the CSV value "007", but
+# would not be matched with it - the row would be inserted again. So only
+# varchar keys can be used there.
+def check_text_key(conf, column, feature):
+    if (conf["column_types"][column] != "varchar"):
+        raise Exception("Key column '{0}' must be a varchar column ('{0}_varchar' in [get_database_data].columns_list) to use {1}.".format(column, feature))
+
+
+def get_lookup_batch_size(conf):
+    if (conf["lookup"] != "batch"):
+        return 1
+    
+    return get_select_int_setting(conf, "lookup_batch_size", lookup_batch_size_default)
+
+
+def get_select_int_setting(conf, name, default):
+    if (name not in conf["select"]):
+        return default
+    
+    val                         = int(conf["select"][name])
+    if (val < 1):
+        raise Exception("Invalid [get_database_data].{0}: {1}".format(name, val))
+    
+    return val
+
+
+# Key tuple -> database row. Kept in memory until it gets too big, then
+# moved to a temporary dbm file on disk.
+class SnapshotIndex:
+    def __init__(self, max_memory_rows):
+        self.rows               = {}
+        self.disk               = None
+        self.tmpdir             = None
+        self.max_memory_rows    = max_memory_rows
+        self.count              = 0
+    
+    def spill(self):
+        self.tmpdir             = tempfile.mkdtemp(prefix="csv_import_snapshot_")
+        self.disk               = dbm.open(os.path.join(self.tmpdir, "index"), "n")
+        debug_print("Snapshot index moved to disk: {0}", self.tmpdir)
+        
+        for key in self.rows:
+            self.disk[pickle.dumps(key)] = pickle.dumps(self.rows[key])
+        self.rows               = {}
+    
+    def get(self, key, default=None):
+        if (self.disk == None):
+            return self.rows.get(key, default)
+        
+        diskkey                 = pickle.dumps(key)
+        if (diskkey not in self.disk):
+            return default
+        
+        return pickle.loads(self.disk[diskkey])
+    
+    def __contains__(self, key):
+        if (self.disk == None):
+            return key in self.rows
+        
+        return pickle.dumps(key) in self.disk
+    
+    def __setitem__(self, key, row):
+        if (key not in self):
+            self.count          = self.count + 1
+        
+        if (self.disk == None):
+            self.rows[key]      = row
+            if (len(self.rows) > self.max_memory_rows):
+                self.spill()
+            return
+        
+        self.disk[pickle.dumps(key)] = pickle.dumps(row)
+    
+    def __len__(self):
+        return self.count
+    
+    def close(self):
+        self.rows               = {}
+        if (self.disk != None):
+            self.disk.close()
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.disk           = None
+
+
+# One sequential scan of the table with a server-side cursor, instead
+# of one lookup per CSV row
+def get_snapshot_index(conf):
+    db                          = conf["db"]["type"]
+    itersize                    = get_select_int_setting(conf, "snapshot_itersize", snapshot_itersize_default)
+    index                       = SnapshotIndex(get_select_int_setting(conf, "snapshot_memory_rows", snapshot_memory_rows_default))
+    sql                         = "select {0} from {1};".format(', '.join(conf["column_types"].keys()), conf["db"][db]["table"])
+    
+    debug_print("EXECUTING: {0}", sql)
+    
+    snapshot_cursor             = connection.cursor(name="csv_import_snapshot")
+    snapshot_cursor.itersize    = itersize
+    snapshot_cursor.execute(sql)
+    
+    try:
+        for dbrow in snapshot_cursor:
+            key                 = get_db_key(conf, dbrow)
+            
+            # A worker needs only the keys it gets from the CSV
+            if ("worker" in conf and get_key_partition(key, conf["worker"][1]) != conf["worker"][0] - 1):
+                continue
+            
+            if (key in index):
+                check_single_record(conf, 2, "{0} -- key: {1}".format(sql, key))
+            index[key]          = dbrow
+    finally:
+        snapshot_cursor.close()
+    
+    print("* Snapshot of {0} rows loaded.".format(len(index)))
+    
+    return index
+
+
+def get_csv_key(conf, csvrow):
+    key                         = []
+    
+    for column, csvcol, index, converter in conf["row_plan"]["keys"]:
+        val                     = csvrow[index]
+        
+        # Incomplete key - this row can not be matched in a batch
+        if (val == None or val == ""):
+            return None
+        
+        key.append(val)
+    
+    return tuple(key)
+
+
+def get_db_key(conf, dbrow):
+    key                         = []
+    
+    for index in conf["row_plan"]["key_db_indexes"]:
+        key.append(str(dbrow[index]))
+    
+    return tuple(key)
+
+
+def get_csv_db_row(conf, csvrow):
+    # The row as it will look like in the database after INSERT/UPDATE
+    dbrow                       = []
+    
+    for column, csvcol, index, converter in conf["row_plan"]["db_row"]:
+        if (index == None):
+            dbrow.append(None)  # Not in the CSV
+        else:
+            dbrow.append(converter(csvrow[index]))
+    
+    return tuple(dbrow)
+
+
+def check_single_record(conf, total_records, sql_select):
+    if (total_records > 1):
+        print()
+        print("PROBLEM: More than one record found, as a result of this SELECT. This is not what we expect. The keys you specify in your INI, section [get_database_data].keys_list must uniquely identify only one record. Unless somebody messed-up your database.")
+        print("SELECT: {0}".format(sql_select))
+        print("Key columns: {0}".format(conf["select"]["keys_list"]))
+        raise Exception("Key columns do not identify uniqely one record or multiple records exist in database.")
+
+
+# "dbcursor" is for engines with more than one connection
+def lookup_db_row(conf, csvrow, dbcursor=None):
+    rowcnt                      = conf["current_csv_line"]
+    sql_select, params          = get_select_query(conf, csvrow)
+    
+    if (sql_select == ""):
+        #skipcnt         = skipcnt + 1
+        #continue ### Nah, this is not a minor exception, so we will crash
+        raise Exception("CSV Line: {0}; Blank value for a key column. All values for key columns must not be blank. Invalid CSV file.".format(rowcnt))
+    
+    debug_print("EXECUTING: {0} {1}", sql_select, params)
+    
+    if (dbcursor == None):
+        execute_query(conf, sql_select, params)
+        dbcursor                = cursor
+    else:
+        dbcursor.execute(sql_select, params)
+    
+    # Not all drivers know the number of rows before they are fetched
+    dbrows                      = dbcursor.fetchall()
+    total_records               = len(dbrows)
+    debug_print("Total SELECTed rows: {0}", total_records)
+    
+    check_single_record(conf, total_records, sql_select)
+    
+    # We have 0 or 1 result
+    dbrow                       = None
+    for dbrow in dbrows:
+        debug_print("SELECT: {0}", dbrow)
+    
+    return dbrow
+
+
+def lookup_db_rows(conf, chunk, dbcursor=None):
+    # One SELECT for all the complete keys in this chunk
+    keys                        = {}
+    for rowcnt, csvrow in chunk:
+        key                     = get_csv_key(conf, csvrow)
+        if (key != None):
+            keys[key]           = True
+    
+    results                     = {}
+    if (len(keys) == 0):
+        return results
+    
+    sql_select, params          = get_batch_select_query(conf, list(keys.keys()))
+    debug_print("EXECUTING: {0} {1}", sql_select, params)
+    
+    if (dbcursor == None):
+        dbcursor                = cursor
+    
+    dbcursor.execute(sql_select, params)
+    debug_print("Total SELECTed rows: {0}", dbcursor.rowcount)
+    
+    for dbrow in dbcursor:
+        debug_print("SELECT: {0}", dbrow)
+        
+        key                     = get_db_key(conf, dbrow)
+        if (key in results):
+            check_single_record(conf, 2, sql_select)
+        
+        results[key]            = dbrow
+    
+    return results
+
+
+# "compare" tells where each compared column is in both rows - by
+# default the CSV row and the "columns_list" database row
+# All differing "columns_list" columns: (column, database value, CSV value)
+def get_row_differences(conf, csvrow, dbrow, compare=None):
+    plan                        = conf["row_plan"]
+    differences                 = []
+    if (compare == None):
+        compare                 = plan["compare"]
+    
+    for colname, csvindex, dbindex, varchar in compare:
+        dbval                   = dbrow[dbindex]
+        csvval                  = csvrow[csvindex]
+        
+        # Special situation - if value type is not varchar,
+        # then if we get empty value in the CSV, it should be
+        # interpreted as NULL
+        if (not varchar and csvval == ''):
+            csvval              = None
+        
+        if (varchar and dbval == None and plan["null_equals_to_empty"]):
+            dbval               = ''
+        
+        debug_print(">>>> compare: (db)'{0}' != '{1}'(csv)", dbval, csvval)
+        if (dbval != csvval):
+            differences.append((colname, dbval, csvval))
+    
+    return differences
+
+
+# A new row as differences: (column, None, CSV value)
+def get_new_row_values(csvrow, compare):
+    values                      = []
+    
+    for colname, csvindex, dbindex, varchar in compare:
+        csvval                  = csvrow[csvindex]
+        if (not varchar and csvval == ''):
+            csvval              = None
+        values.append((colname, None, csvval))
+    
+    return values
+
+
+def get_row_values(row, indexes):
+    return [row[index] for index in indexes]
+
+
+# Decides what to do with the CSV row: "inserts", "updates" or "skips"
+def get_csv_row_action(conf, rowcnt, csvrow, dbrow, summary, unchanged=False):
+    started                     = time.perf_counter()
+    action                      = get_row_action(conf, rowcnt, csvrow, dbrow, summary, unchanged)
+    observe_phase("compare", time.perf_counter() - started)
+    
+    return action
+
+
+# unchanged - already known to be the same as dbrow (compare = vector)
+def get_row_action(conf, rowcnt, csvrow, dbrow, summary, unchanged=False):
+    plan                        = conf["row_plan"]
+    
+    if (dbrow != None):
+        if (unchanged):
+            return "skips"
+        
+        differences             = get_row_differences(conf, csvrow, dbrow)
+        if (len(differences) == 0):
+            return "skips"
+        
+        colname, dbval, csvval  = differences[0]
+        row_print(rowcnt, "updating", conf["csv"]["fields_list"], csvrow)
+        diff_print("\"diff\",\"{0}\",\"{1}\",\"{2}\",\"{3}\"", colname, dbval, rowcnt, csvrow)
+        if (conf["diff_writer"] != None):
+            conf["diff_writer"].add("diff", rowcnt, get_plan_values(plan["keys"], csvrow), differences)
+        summary["updates"]      = summary["updates"] + 1
+        return "updates"
+    
+    row_print(rowcnt, "inserting", conf["csv"]["fields_list"], csvrow)
+    diff_print("\"NEW\",\"\",\"\",\"{0}\",\"{1}\"", rowcnt, csvrow)
+    if (conf["diff_writer"] != None):
+        conf["diff_writer"].add("NEW", rowcnt, get_plan_values(plan["keys"], csvrow), get_new_row_values(csvrow, plan["compare"]))
+    summary["inserts"]          = summary["inserts"] + 1
+    
+    return "inserts"
+
+
+def process_csv_row(conf, rowcnt, csvrow, dbrow, summary, unchanged=False):
+    action                      = get_csv_row_action(conf, rowcnt, csvrow, dbrow, summary, unchanged)
+    sql                         = ""
+    params                      = None
+    increment_column_val        = None
+    
+    if (action == "updates"):
+        sql, params             = get_update_query(conf, csvrow)
+    
+    if (action == "inserts"):
+        increment_column_val    = get_next_id(conf)
+        debug_print("next id: {0}", increment_column_val)
+        sql, params             = get_insert_query(conf, csvrow, increment_column_val)
+    
+    # If anything to do (values exist and differ)
+    debug_print("EXECUTING: {0} {1}", sql, params)
+    if (not debug_mode and not diff_mode):
+        if (sql != "" and conf["write_batch_size"] > 1 and get_csv_key(conf, csvrow) != None):
+            buffer_write(conf, summary, action, csvrow, increment_column_val)
+        elif (sql != ""):
+            # An incomplete key ("is null" in the WHERE) can not be matched
+            # in a batch - the row goes on its own, as in the row mode,
+            # after the rows buffered before it
+            if (conf["write_batch_size"] > 1):
+                flush_writes(conf, summary)
+            
+            if (not execute_write(conf, sql, params)):
+                summary[action] = summary[action] - 1
+                summary["errors"] = summary["errors"] + 1
+                return ""
+        else:
+            row_print(rowcnt, "skipping", conf["csv"]["fields_list"], csvrow)
+            summary["skips"]    = summary["skips"] + 1
+    else:
+        debug_print("SQL query not executed, because of DEBUG_MODE being enabled.")
+    
+    return sql
+
+
+def set_id_strategy(conf):
+    db                          = conf["db"]["type"]
+    strategy                    = "max"
+    
+    if ("id_strategy" in conf["update"]):
+        strategy                = conf["update"]["id_strategy"].lower()
+    
+    if (strategy not in supported_id_strategies):
+        raise Exception("Unknown [update_database_data].id_strategy: {0}. Supported: {1}".format(strategy, ', '.join(supported_id_strategies)))
+    
+    # Nothing to increment - the database takes care of the IDs
+    if ("increment_column" not in conf["update"]):
+        strategy                = "default"
+    
+    conf["id_strategy"]         = strategy
+    conf["id_block"]            = []
+    conf["id_locked"]           = False
+    conf["last_id"]             = None
+    
+    if (strategy == "local" and conf["backend"].lock_table == None):
+        raise Exception("[update_database_data].id_strategy = local is not supported on {0}.".format(db))
+    
+    # The commit releases the lock - with a commit after each row every
+    # INSERT would lock the table and run MAX() again (the copy engine
+    # writes all rows with one query)
+    if (strategy == "local" and conf.get("commit_every") == 1):
+        raise Exception("[update_database_data].id_strategy = local needs commit_every > 1 or single_transaction = yes.")
+    
+    if (strategy in ["max", "local"]):
+        conf["sql_get_next_id"] = get_next_id_query(conf)
+    
+    if (strategy == "sequence"):
+        if (db != "postgresql"):
+            raise Exception("[update_database_data].id_strategy = sequence is supported on PostgreSQL only.")
+        
+        block_size              = id_block_size_default
+        if ("id_block_size" in conf["update"]):
+            block_size          = int(conf["update"]["id_block_size"])
+        if (block_size < 1):
+            raise Exception("Invalid [update_database_data].id_block_size: {0}".format(block_size))
+        conf["id_block_size"]   = block_size
+        
+        if ("id_sequence" in conf["update"]):
+            conf["id_sequence"] = conf["update"]["id_sequence"]
+        else:
+            # The sequence behind a serial column
+            cursor.execute("select pg_get_serial_sequence(%s, %s);", (conf["db"][db]["table"], conf["update"]["increment_column"]))
+            conf["id_sequence"] = cursor.fetchone()[0]
+            if (conf["id_sequence"] == None):
+                raise Exception("No sequence found for column '{0}'. Set [update_database_data].id_sequence.".format(conf["update"]["increment_column"]))
+        
+        debug_print("ID sequence: {0}", conf["id_sequence"])
+
+
+def get_next_id(conf):
+    strategy                    = conf["id_strategy"]
+    
+    if (strategy == "default"):
+        return None
+    
+    if (strategy == "sequence"):
+        # Nothing is reserved when nothing is written
+        if (debug_mode or diff_mode):
+            return None
+        
+        if (len(conf["id_block"]) == 0):
+            cursor.execute("select nextval(%s) from generate_series(1, %s);", (conf["id_sequence"], conf["id_block_size"]))
+            conf["id_block"]    = sorted([row[0] for row in cursor], reverse=True)
+            debug_print("Reserved IDs: {0} - {1}", conf["id_block"][-1], conf["id_block"][0])
+        
+        return conf["id_block"].pop()
+    
+    # MAX()+1 once per transaction, then increment. The table lock keeps
+    # everybody else from inserting until we commit.
+    if (strategy == "local"):
+        if (conf["id_locked"]):
+            conf["last_id"]     = conf["last_id"] + 1
+            return conf["last_id"]
+        
+        if (not debug_mode and not diff_mode):
+            db                  = conf["db"]["type"]
+            cursor.execute(conf["backend"].lock_table.format(conf["db"][db]["table"]))
+            conf["id_locked"]   = True
+    
+    # Buffered INSERTs are not in the table yet, so continue from the
+    # last ID given to them
+    if (strategy == "max" and conf["last_id"] != None and len(conf["write_buffers"]["inserts"]) > 0):
+        conf["last_id"]         = conf["last_id"] + 1
+        return conf["last_id"]
+    
+    execute_query(conf, conf["sql_get_next_id"])
+    singlerow                   = cursor.fetchone()
+    conf["last_id"]             = singlerow[0] # Single value
+    
+    return conf["last_id"]
+
+
+def commit(conf):
+    connection.commit()
+    
+    # Savepoints and locks are gone with the transaction
+    conf["savepoint_set"]       = False
+    conf["id_locked"]           = False
+
+
+def get_write_batch_size(conf):
+    if ("write_batch_size" not in conf["update"]):
+        return 1
+    
+    batch_size                  = int(conf["update"]["write_batch_size"])
+    if (batch_size < 1):
+        raise Exception("Invalid [update_database_data].write_batch_size: {0}".format(batch_size))
+    
+    return batch_size
+
+
+def get_column_sql_types(conf):
+    db                          = conf["db"]["type"]
+    sql                         = "select a.attname, format_type(a.atttypid, a.atttypmod) from pg_attribute a where a.attrelid = %s::regclass and a.attnum > 0 and not a.attisdropped;"
+    
+    debug_print("EXECUTING: {0}", sql)
+    cursor.execute(sql, (conf["db"][db]["table"],))
+    
+    types                       = {}
+    for column, sqltype in cursor:
+        types[column]           = sqltype
+    
+    return types
+
+
+# One row waiting in a write buffer. Only the CSV row is kept - its
+# query is made again only if the batch fails.
+class BufferedWrite:
+    __slots__                   = ("line", "csvrow", "nextid")
+    
+    def __init__(self, line, csvrow, nextid):
+        self.line               = line
+        self.csvrow             = csvrow
+        self.nextid             = nextid
+
+
+# Only rows with a complete key - see process_csv_row()
+def buffer_write(conf, summary, action, csvrow, nextid):
+    key                         = get_csv_key(conf, csvrow)
+    conf["write_buffers"][action].append(BufferedWrite(conf["current_csv_line"], csvrow, nextid))
+    conf["pending_rows"][key]   = True
+    
+    if (len(conf["write_buffers"][action]) >= conf["write_batch_size"]):
+        flush_writes(conf, summary)
+
+
+def flush_writes(conf, summary):
+    # INSERTs first - a buffered UPDATE may be for a row inserted in the
+    # same batch
+    for action in ["inserts", "updates"]:
+        rows                    = conf["write_buffers"][action]
+        if (len(rows) == 0):
+            continue
+        
+        execute_batch_write(conf, summary, action, rows)
+        conf["write_buffers"][action] = []
+    
+    conf["pending_rows"]        = {}
+
+
+def get_plan_values(plan_columns, csvrow):
+    values                      = []
+    
+    for column, csvcol, index, converter in plan_columns:
+        values.append(converter(csvrow[index]))
+    
+    return values
+
+
+def get_batch_insert_query(conf, rows):
+    db                          = conf["db"]["type"]
+    insert_columns, values      = get_batch_insert_values(conf, rows)
+    sql                         = "insert into {0} ({1}) values %s;".format(conf["db"][db]["table"], ', '.join(insert_columns))
+    
+    return sql, None, values
+
+
+def get_batch_insert_values(conf, rows):
+    plan_columns                = conf["row_plan"]["insert"]
+    insert_columns              = [column[0] for column in plan_columns]
+    
+    if (conf["id_strategy"] != "default"):
+        insert_columns.append(conf["update"]["increment_column"])
+    
+    values                      = []
+    for row in rows:
+        rowvalues               = get_plan_values(plan_columns, row.csvrow)
+        if (conf["id_strategy"] != "default"):
+            rowvalues.append(row.nextid)
+        values.append(rowvalues)
+    
+    return insert_columns, values
+
+
+# INSERTs of the other databases go as their merge query - a row which
+# is there already (written by somebody else after the lookup) is
+# updated, otherwise inserted
+def get_batch_merge_query(conf, rows):
+    db                          = conf["db"]["type"]
+    keys_list                   = conf["select"]["keys_list"]
+    insert_columns, values      = get_batch_insert_values(conf, rows)
+    
+    cachekey                    = ("merge", tuple(insert_columns))
+    if (cachekey not in conf["query_cache"]):
+        set_columns             = [column for column in conf["update"]["columns_list"] if column not in keys_list]
+        conf["query_cache"][cachekey] = conf["backend"].get_merge_query(conf["db"][db]["table"], insert_columns, keys_list, set_columns)
+    
+    return conf["query_cache"][cachekey], values
+
+
+# UPDATEs of the other databases - the usual UPDATE query, with the
+# parameters of all the rows at once. A row with an empty key column
+# ("is null" in the WHERE) is never buffered (see process_csv_row()),
+# so the query is the same for each of them.
+def get_batch_update_params(conf, rows):
+    values                      = []
+    for row in rows:
+        sql, params             = get_update_query(conf, row.csvrow)
+        values.append(params)
+    
+    return sql, None, values
+
+
+def get_batch_update_query(conf, rows):
+    db                          = conf["db"]["type"]
+    plan_columns                = conf["row_plan"]["batch_update"]
+    columns                     = [column[0] for column in plan_columns]
+    
+    # Values from a VALUES list are text, unless casted to the column type
+    template                    = []
+    for column in columns:
+        template.append("%s::{0}".format(conf["column_sql_types"][column]))
+    
+    set_clause                  = []
+    for column in conf["update"]["columns_list"]:
+        set_clause.append("{0} = v.{0}".format(column))
+    
+    predicate                   = []
+    for column in conf["select"]["keys_list"]:
+        predicate.append("t.{0} = v.{0}".format(column))
+    
+    values                      = []
+    for row in rows:
+        values.append(get_plan_values(plan_columns, row.csvrow))
+    
+    sql                         = "update {0} t set {1} from (values %s) as v ({2}) where {3};".format(conf["db"][db]["table"], ', '.join(set_clause), ', '.join(columns), ' and '.join(predicate))
+    
+    return sql, "({0})".format(', '.join(template)), values
+
+
+def execute_batch_write(conf, summary, action, rows):
+    backend                     = conf["backend"]
+    sql, template, values       = backend.get_batch_write(conf, action, rows)
+    
+    debug_print("EXECUTING: {0} ({1} rows)", sql, len(values))
+    
+    if (conf["commit_every"] == 1):
+        backend.execute_batch_write(cursor, sql, template, values)
+        commit(conf)
+        return
+    
+    if (not conf["savepoint_set"]):
+        backend.set_savepoint(cursor)
+        conf["savepoint_set"] = True
+    
+    try:
+        backend.execute_batch_write(cursor, sql, template, values)
+        backend.execute_savepoint(cursor, "", None)
+    except Exception as e:
+        # Find the bad row(s) - same queries, but one by one
+        backend.rollback_savepoint(cursor)
+        conf["id_locked"]       = False # A lock taken after the savepoint is gone too
+        debug_print("Batch failed, executing row by row: {0}", str(e).strip())
+        
+        current_csv_line        = conf["current_csv_line"]
+        for row in rows:
+            conf["current_csv_line"] = row.line
+            if (action == "inserts"):
+                rowsql, rowparams = get_insert_query(conf, row.csvrow, row.nextid)
+            else:
+                rowsql, rowparams = get_update_query(conf, row.csvrow)
+            
+            if (not execute_write(conf, rowsql, rowparams)):
+                summary[action] = summary[action] - 1
+                summary["errors"] = summary["errors"] + 1
+        
+        conf["current_csv_line"] = current_csv_line
+        return
+    
+    conf["pending_writes"]      = conf["pending_writes"] + len(rows)
+    if (conf["commit_every"] > 1 and conf["pending_writes"] >= conf["commit_every"]):
+        commit_writes(conf)
+
+
+def get_commit_every(conf):
+    if ("single_transaction" in conf["update"] and conf["update"]["single_transaction"].lower() == "yes"):
+        return 0
+    
+    if ("commit_every" not in conf["update"]):
+        return 1
+    
+    commit_every                = int(conf["update"]["commit_every"])
+    if (commit_every < 1):
+        raise Exception("Invalid [update_database_data].commit_every: {0}".format(commit_every))
+    
+    return commit_every
+
+
+# Returns False if the query failed and was rolled back (only possible
+# when more than one row is committed at once)
+def execute_write(conf, sql, params):
+    rowcnt                      = conf["current_csv_line"]
+    commit_every                = conf["commit_every"]
+    
+    if (commit_every == 1):
+        execute_query(conf, sql, params)
+        commit(conf)
+        return True
+    
+    # There is always a savepoint right before the current query, so
+    # even a query which can not be parsed at all can be rolled back.
+    # On PostgreSQL releasing it and setting the next one go in the
+    # same round trip.
+    if (not conf["savepoint_set"]):
+        conf["backend"].set_savepoint(cursor)
+        conf["savepoint_set"] = True
+    
+    sql, params                 = prepare_query(conf, sql, params)
+    try:
+        conf["backend"].execute_savepoint(cursor, sql, params)
+    except Exception as e:
+        conf["backend"].rollback_savepoint(cursor)
+        conf["id_locked"]       = False # A lock taken after the savepoint is gone too
+        add_application_issue(sql_issue, rowcnt, " " + str(e).strip())
+        print("[{0}] FAILED: {1}".format(rowcnt, str(e).strip()))
+        return False
+    
+    conf["pending_writes"]      = conf["pending_writes"] + 1
+    if (commit_every > 1 and conf["pending_writes"] >= commit_every):
+        commit_writes(conf)
+    
+    return True
+
+
+def commit_writes(conf):
+    if (conf["pending_writes"] == 0):
+        return
+    
+    debug_print("COMMIT: {0} queries", conf["pending_writes"])
+    commit(conf)
+    conf["pending_writes"]      = 0
+
+
+def get_empty_summary():
+    summary                     = {
+        "total"     : 0,
+        "inserts"   : 0,
+        "updates"   : 0,
+        "skips"     : 0,
+        "errors"    : 0
+    }
+    
+    return summary
+
+
+def add_summaries(summary, other):
+    added                       = get_empty_summary()
+    for key in added:
+        added[key]              = summary[key] + other[key]
+    
+    return added
+
+
+def get_compare_mode(conf):
+    mode                        = "row"
+    if ("compare" in conf["update"]):
+        mode                    = conf["update"]["compare"].lower()
+    
+    if (mode not in supported_compares):
+        raise Exception("Unknown [update_database_data].compare: {0}. Supported: {1}".format(mode, ', '.join(supported_compares)))
+    
+    if (mode == "vector" and pyarrow == None):
+        raise Exception("compare = vector needs the 'pyarrow' module: pip install pyarrow")
+    
+    if (mode == "vector" and conf["lookup"] == "row"):
+        raise Exception("[update_database_data].compare = vector needs [get_database_data].lookup = batch or snapshot.")
+    
+    return mode
+
+
+# compare = vector: which rows of the chunk are the same as their
+# database row, worked out column by column with Arrow instead of row by
+# row - same rules as get_row_differences(). Only the first row of each
+# key is checked, a later one must see what the first one wrote. The
+# other rows are compared by get_row_differences() as usual.
+def get_unchanged_rows(conf, chunk, keys, dbrows):
+    unchanged                   = [False] * len(chunk)
+    if (conf["compare"] != "vector"):
+        return unchanged
+    
+    plan                        = conf["row_plan"]
+    positions                   = []
+    csvrows                     = []
+    found                       = []
+    checked                     = {}
+    
+    for i in range(len(chunk)):
+        key                     = keys[i]
+        if (key == None or key in checked):
+            continue
+        checked[key]            = True
+        
+        dbrow                   = dbrows.get(key)
+        if (dbrow == None):
+            continue
+        
+        positions.append(i)
+        csvrows.append(chunk[i][1])
+        found.append(dbrow)
+    
+    if (len(positions) == 0):
+        return unchanged
+    
+    compute                     = pyarrow.compute
+    same                        = pyarrow.array([True] * len(positions))
+    for colname, csvindex, dbindex, varchar in plan["compare"]:
+        csvvals                 = pyarrow.array([csvrow[csvindex] for csvrow in csvrows], type=pyarrow.string())
+        text                    = None
+        try:
+            dbvals              = pyarrow.array([dbrow[dbindex] for dbrow in found], type=pyarrow.string())
+        except (pyarrow.ArrowTypeError, pyarrow.ArrowInvalid):
+            # A value which is not text (a number, a date) never equals
+            # the CSV string - it is compared as NULL, and then only the
+            # text values and the NULLs can be equal
+            values              = [dbrow[dbindex] for dbrow in found]
+            text                = pyarrow.array([value == None or isinstance(value, str) for value in values])
+            dbvals              = pyarrow.array([value if isinstance(value, str) else None for value in values], type=pyarrow.string())
+        
+        if (varchar):
+            if (plan["null_equals_to_empty"]):
+                dbvals          = compute.fill_null(dbvals, "")
+            equal               = compute.fill_null(compute.equal(dbvals, csvvals), False)
+        else:
+            # Empty CSV value is NULL - equal only to NULL
+            csvnull             = compute.equal(csvvals, "")
+            equal               = compute.fill_null(compute.and_(compute.equal(dbvals, csvvals), compute.invert(csvnull)), False)
+            equal               = compute.or_(equal, compute.and_(csvnull, compute.is_null(dbvals)))
+        
+        if (text != None):
+            equal               = compute.and_(equal, text)
+        
+        same                    = compute.and_(same, equal)
+    
+    for i, rowsame in zip(positions, same.to_pylist()):
+        unchanged[i]            = rowsame
+    
+    return unchanged
+
+
+def import_csv_rows(conf, rows):
+    conf["lookup"]              = get_lookup_mode(conf)
+    lookup_batch_size           = get_lookup_batch_size(conf)
+    conf["compare"]             = get_compare_mode(conf)
+    conf["commit_every"]        = get_commit_every(conf)
+    conf["pending_writes"]      = 0
+    conf["savepoint_set"]       = False
+    conf["write_batch_size"]    = get_write_batch_size(conf)
+    conf["write_buffers"]       = {"inserts": [], "updates": []}
+    conf["pending_rows"]        = {}
+    set_id_strategy(conf)
+    
+    summary                     = get_empty_summary()
+    
+    if (conf["write_batch_size"] > 1 and conf["db"]["type"] == "postgresql" and not debug_mode and not diff_mode):
+        conf["column_sql_types"] = get_column_sql_types(conf)
+    
+    snapshot                    = None
+    if (conf["lookup"] == "snapshot"):
+        snapshot                = get_snapshot_index(conf)
+    
+    try:
+        for chunk in get_csv_chunks(conf, rows, lookup_batch_size):
+            dbrows              = {}
+            if (snapshot != None):
+                dbrows          = snapshot
+            
+            if (conf["lookup"] == "batch"):
+                # The lookup must see all buffered INSERTs and UPDATEs
+                flush_writes(conf, summary)
+                dbrows          = lookup_db_rows(conf, chunk)
+            
+            keys                = [get_csv_key(conf, csvrow) for rowcnt, csvrow in chunk]
+            unchanged_rows      = get_unchanged_rows(conf, chunk, keys, dbrows)
+            
+            for (rowcnt, csvrow), key, unchanged in zip(chunk, keys, unchanged_rows):
+                conf["current_csv_line"] = rowcnt
+                summary["total"]= summary["total"] + 1
+                
+                # Same key again (or a key which can not be tracked) -
+                # the buffered queries go first
+                if (len(conf["pending_rows"]) > 0 and (key == None or key in conf["pending_rows"])):
+                    flush_writes(conf, summary)
+                
+                if (conf["lookup"] != "row" and key != None):
+                    dbrow       = dbrows.get(key)
+                else:
+                    dbrow       = lookup_db_row(conf, csvrow)
+                
+                sql             = process_csv_row(conf, rowcnt, csvrow, dbrow, summary, unchanged)
+                
+                # Later rows of the same chunk (or file) may have the same key
+                if (sql != "" and key != None and not debug_mode and not diff_mode):
+                    dbrows[key] = get_csv_db_row(conf, csvrow)
+            
+            if (conf["checkpoint"] != None and time.time() >= conf["checkpoint"]["next_save"]):
+                save_checkpoint(conf, summary, chunk[-1][0])
+    
+    finally:
+        if (snapshot != None):
+            snapshot.close()
+    
+    flush_writes(conf, summary)
+    commit_writes(conf)
+    
+    return summary
+
+
+def read_csv_file(conf, fn):
+    global application_issues_list
+    
+    store                       = get_fingerprint_store(conf)
+    unchanged                   = get_empty_summary()
+    if (conf["checkpoint"] != None):
+        conf["checkpoint"]["unchanged"] = unchanged
+    
+    rows                        = None
+    try:
+        # with open('eggs.csv', newline='') as csvfile:
+        with open_csv_file(conf, fn) as fh:
+            rows                = get_csv_file_rows(conf, fn, fh)
+            if (store != None):
+                rows            = get_changed_rows(conf, rows, store, unchanged)
+            
+            diff_print("\"STATUS\",\"DATABASE_COLUMN\",\"DATABASE_VALUE\",\"LINE\",\"{0}\"", os.path.basename(fn))
+            
+            if (workers > 1):
+                summary         = import_csv_rows_parallel(conf, rows)
+            elif (conf["engine"] == "async"):
+                summary         = import_csv_rows_async(conf, rows)
+            elif (conf["engine"] == "upsert"):
+                summary         = import_csv_rows_upsert(conf, rows)
+            else:
+                summary         = import_csv_rows(conf, rows)
+        
+        checkpoint              = conf["checkpoint"]
+        if (checkpoint != None):
+            summary             = add_summaries(summary, checkpoint["summary"])
+            remove_checkpoint(checkpoint)
+        
+        summary                 = add_summaries(summary, unchanged)
+        
+        # The rows before the checkpoint were not read, so their
+        # fingerprints are not known
+        if (store != None and summary["errors"] == 0 and (checkpoint == None or not checkpoint["resumed"])):
+            save_fingerprint_store(store)
+    finally:
+        # Not read to the end after an error - stops the --parsers
+        if (rows != None):
+            rows.close()
+        if (store != None):
+            store.close()
+    
+    print_summary(summary)
+    return summary
+
+
+# Hashes of the "columns_list" [update_database_data] values of each key,
+# as they were after the last successful import. Kept in a SQLite file
+# in conf/. New hashes go to a new file, which replaces the old one only
+# when the import was successful.
+class FingerprintStore:
+    def __init__(self, fn):
+        self.fn                 = fn
+        self.newfn              = "{0}.new".format(fn)
+        self.old                = None
+        self.saved              = False
+        
+        if (os.path.exists(fn)):
+            self.old            = sqlite3.connect(fn, check_same_thread=False)
+        
+        if (os.path.exists(self.newfn)):
+            os.remove(self.newfn)
+        
+        self.new                = sqlite3.connect(self.newfn, check_same_thread=False)
+        self.new.execute("create table fingerprints (key text primary key, fingerprint blob) without rowid;")
+    
+    def get(self, key):
+        if (self.old == None):
+            return None
+        
+        row                     = self.old.execute("select fingerprint from fingerprints where key = ?;", (key,)).fetchone()
+        if (row == None):
+            return None
+        
+        return bytes(row[0])
+    
+    # Already added by this import
+    def __contains__(self, key):
+        return self.new.execute("select 1 from fingerprints where key = ?;", (key,)).fetchone() != None
+    
+    def add(self, key, fingerprint):
+        self.new.execute("insert or replace into fingerprints (key, fingerprint) values (?, ?);", (key, fingerprint))
+    
+    def save(self):
+        self.new.commit()
+        self.new.close()
+        self.new                = None
+        if (self.old != None):
+            self.old.close()
+            self.old            = None
+        
+        os.replace(self.newfn, self.fn)
+        self.saved              = True
+    
+    def close(self):
+        if (self.old != None):
+            self.old.close()
+        if (self.new != None):
+            self.new.close()
+        if (not self.saved and os.path.exists(self.newfn)):
+            os.remove(self.newfn)
+
+
+def get_fingerprint_store(conf):
+    if ("incremental" not in conf["update"] or conf["update"]["incremental"].lower() != "yes"):
+        if (fingerprints_action != None):
+            raise Exception("--fingerprints needs [update_database_data].incremental = yes.")
+        return None
+    
+    fn                          = get_fingerprint_file(conf)
+    if (fingerprints_action != None):
+        rebuild_fingerprint_store(conf, fn, fingerprints_action)
+    
+    debug_print("Fingerprints: {0}", fn)
+    return FingerprintStore(fn)
+
+
+def get_fingerprint_file(conf):
+    return re.sub(r'\.ini$', '', conf["conffn"]) + ".fingerprints"
+
+
+def save_fingerprint_store(store):
+    # Nothing was written, so nothing may be remembered as written
+    if (debug_mode or diff_mode):
+        return
+    
+    store.save()
+    debug_print("Fingerprints saved: {0}", store.fn)
+
+
+def get_fingerprint_key(key):
+    return "\x1f".join(key)
+
+
+def get_fingerprint(values):
+    data                        = []
+    for val in values:
+        if (val == None):
+            data.append("\x1e")   # NULL is not the same as an empty value
+        else:
+            data.append(str(val))
+    
+    return hashlib.md5("\x1f".join(data).encode("utf-8")).digest()
+
+
+def get_row_fingerprint(conf, csvrow):
+    return get_fingerprint(get_plan_values(conf["row_plan"]["update"], csvrow))
+
+
+def get_db_fingerprint(conf, dbrow):
+    values                      = []
+    
+    for colname, csvindex, dbindex, varchar in conf["row_plan"]["compare"]:
+        val                     = dbrow[dbindex]
+        if (varchar and val == None and conf["row_plan"]["null_equals_to_empty"]):
+            val                 = ''
+        values.append(val)
+    
+    return get_fingerprint(values)
+
+
+# Rows with the same fingerprint as after the last import are counted as
+# skipped and never reach the database
+def get_changed_rows(conf, rows, store, summary):
+    for rowcnt, csvrow in rows:
+        key                     = get_csv_key(conf, csvrow)
+        if (key == None):
+            yield rowcnt, csvrow
+            continue
+        
+        key                     = get_fingerprint_key(key)
+        fingerprint             = get_row_fingerprint(conf, csvrow)
+        
+        # A key found again in the same file may have been changed by
+        # its previous row, so only its first row can be skipped
+        seen                    = key in store
+        store.add(key, fingerprint)
+        
+        if (not seen and store.get(key) == fingerprint):
+            debug_print("[{0}] unchanged since the last import", rowcnt)
+            summary["total"]    = summary["total"] + 1
+            summary["skips"]    = summary["skips"] + 1
+            continue
+        
+        yield rowcnt, csvrow
+
+
+# The fingerprints are made from the table instead of the CSV file.
+# "verify" keeps only the stored ones, which still match the table.
+def rebuild_fingerprint_store(conf, fn, action):
+    db                          = conf["db"]["type"]
+    if (db != "postgresql"):
+        raise Exception("--fingerprints is supported on PostgreSQL only.")
+    
+    if (conf["row_plan"]["key_db_indexes"] == None):
+        raise Exception("All [get_database_data].keys_list columns must also be in [get_database_data].columns_list to use --fingerprints.")
+    
+    print("* Fingerprints {0} ...".format(action))
+    
+    store                       = FingerprintStore(fn)
+    sql                         = "select {0} from {1};".format(', '.join(conf["column_types"].keys()), conf["db"][db]["table"])
+    debug_print("EXECUTING: {0}", sql)
+    
+    scan_cursor                 = connection.cursor(name="csv_import_fingerprints")
+    scan_cursor.itersize        = get_select_int_setting(conf, "snapshot_itersize", snapshot_itersize_default)
+    scan_cursor.execute(sql)
+    
+    kept                        = 0
+    dropped                     = 0
+    try:
+        for dbrow in scan_cursor:
+            key                 = get_fingerprint_key(get_db_key(conf, dbrow))
+            fingerprint         = get_db_fingerprint(conf, dbrow)
+            
+            if (action == "verify" and store.get(key) != fingerprint):
+                if (store.get(key) != None):
+                    dropped     = dropped + 1
+                continue
+            
+            store.add(key, fingerprint)
+            kept                = kept + 1
+        
+        scan_cursor.close()
+        connection.commit()     # The named cursor left a transaction open
+        store.save()
+    finally:
+        store.close()
+    
+    if (action == "verify"):
+        print("* Fingerprints verified: {0} match the table, {1} do not and were removed.".format(kept, dropped))
+    else:
+        print("* Fingerprints created from the table: {0}".format(kept))
+    print()
+
+
+# Where a resumed import continues - the byte offset and the line after
+# the last committed row, and the summary so far. Saved in conf/ at the
+# end of a chunk (all its rows committed first), at most once every
+# checkpoint_seconds. Removed when the import ends.
+def get_checkpoint(conf, fn):
+    if (not resume_mode and ("checkpoint" not in conf["update"] or conf["update"]["checkpoint"].lower() != "yes")):
+        return None
+    
+    if (fn == "-" or workers > 1 or parsers > 1 or conf["engine"] != "row"):
+        raise Exception("Checkpoints work with the 'row' engine only, without --workers and --parsers, and not with the standard input.")
+    
+    if (get_commit_every(conf) == 0):
+        raise Exception("Checkpoints can not be used with [update_database_data].single_transaction = yes.")
+    
+    checkpoint                  = {
+        "fn"        : re.sub(r'\.ini$', '', conf["conffn"]) + ".checkpoint",
+        "csv_file"  : os.path.abspath(fn),
+        "line"      : 0,
+        "summary"   : get_empty_summary(),
+        "unchanged" : get_empty_summary(),
+        "position"  : [0],          # Byte offset of the next row, kept by the reader
+        "resumed"   : False,
+        "seconds"   : get_update_int_setting(conf, "checkpoint_seconds", checkpoint_seconds_default),
+        "next_save" : 0
+    }
+    checkpoint["next_save"]     = time.time() + checkpoint["seconds"]
+    
+    if (not resume_mode):
+        return checkpoint
+    
+    if (not os.path.isfile(checkpoint["fn"])):
+        raise Exception("Nothing to resume, checkpoint file not found: {0}".format(checkpoint["fn"]))
+    
+    with open(checkpoint["fn"]) as fh:
+        state                   = json.load(fh)
+    
+    if (state["csv_file"] != checkpoint["csv_file"]):
+        raise Exception("The checkpoint is for another CSV file: {0}".format(state["csv_file"]))
+    
+    size                        = os.path.getsize(fn)
+    if (get_compressed_extension(fn) == None and state["offset"] > size):
+        raise Exception("The CSV file is shorter than the checkpoint offset {0}.".format(state["offset"]))
+    
+    if (state["size"] != size or state["mtime"] != os.path.getmtime(fn)):
+        print("* WARNING: The CSV file was changed after the checkpoint.")
+    
+    checkpoint["line"]          = state["line"]
+    checkpoint["summary"]       = state["summary"]
+    checkpoint["position"]      = [state["offset"]]
+    checkpoint["resumed"]       = True
+    
+    print("* Resuming after line {0} (byte {1}) ...".format(state["line"], state["offset"]))
+    print()
+    
+    return checkpoint
+
+
+def get_update_int_setting(conf, name, default):
+    if (name not in conf["update"]):
+        return default
+    
+    val                         = int(conf["update"][name])
+    if (val < 1):
+        raise Exception("Invalid [update_database_data].{0}: {1}".format(name, val))
+    
+    return val
+
+
+# The CSV lines from the checkpoint offset on. position[0] is the offset
+# of the next line - the csv module reads no further than the end of the
+# current row.
+def get_checkpoint_lines(fn, fh, position):
+    rawfh                       = fh.buffer
+    if (position[0] > 0):
+        if (not rawfh.seekable()):
+            raise Exception("Can not resume, the CSV file can not seek: {0}".format(fn))
+        rawfh.seek(position[0])
+    
+    for line in rawfh:
+        position[0]             = position[0] + len(line)
+        yield line.decode(fh.encoding)
+
+
+def save_checkpoint(conf, summary, rowcnt):
+    checkpoint                  = conf["checkpoint"]
+    checkpoint["next_save"]     = time.time() + checkpoint["seconds"]
+    
+    # Nothing was written
+    if (debug_mode or diff_mode):
+        return
+    
+    # Every row up to here must be in the database first
+    flush_writes(conf, summary)
+    commit_writes(conf)
+    
+    state                       = {
+        "csv_file"  : checkpoint["csv_file"],
+        "size"      : os.path.getsize(checkpoint["csv_file"]),
+        "mtime"     : os.path.getmtime(checkpoint["csv_file"]),
+        "offset"    : checkpoint["position"][0],
+        "line"      : rowcnt,
+        "summary"   : add_summaries(add_summaries(summary, checkpoint["summary"]), checkpoint["unchanged"])
+    }
+    
+    newfn                       = "{0}.new".format(checkpoint["fn"])
+    with open(newfn, "w") as fh:
+        json.dump(state, fh, indent=4)
+    os.replace(newfn, checkpoint["fn"])
+    
+    debug_print("Checkpoint: line {0}, byte {1}", rowcnt, state["offset"])
+
+
+def remove_checkpoint(checkpoint):
+    if (debug_mode or diff_mode):
+        return
+    
+    if (os.path.exists(checkpoint["fn"])):
+        os.remove(checkpoint["fn"])
+
+
+def get_key_partition(key, partitions):
+    if (key == None):
+        return 0
+    
+    # Stable in every process, unlike hash()
+    return zlib.crc32("\x1f".join(key).encode("utf-8")) % partitions
+
+
+def import_worker(conf, worker_no, rowqueue, resultqueue):
+    global connection
+    global cursor
+    global application_issues_list
+    
+    # Own connection - the parent's one must not be used by the children
+    conf["worker"]              = (worker_no, workers)
+    application_issues_list     = ApplicationIssues()
+    set_run_stats()
+    summary                     = get_empty_summary()
+    error                       = None
+    
+    try:
+        connection              = get_database_connection(conf)
+        cursor                  = connection.cursor()
+        
+        summary                 = import_csv_rows(conf, get_queued_rows(rowqueue))
+        
+        cursor.close()
+        connection.close()
+    except Exception as e:
+        error                   = "[WORKER {0}] {1}".format(worker_no, e)
+        
+        # Drain the queue, so the parent is not blocked
+        for row in get_queued_rows(rowqueue):
+            pass
+    
+    resultqueue.put((worker_no, summary, application_issues_list, run_stats, error))
+
+
+def get_queued_rows(rowqueue):
+    while (True):
+        chunk                   = rowqueue.get()
+        if (chunk == None):
+            return
+        
+        for row in chunk:
+            yield row
+
+
+def import_csv_rows_parallel(conf, rows):
+    if (conf["db"]["type"] != "postgresql" or get_engine(conf) != "row"):
+        raise Exception("--workers is supported with the 'row' engine on PostgreSQL only.")
+    
+    # "max" gives the same ID to two workers, "local" keeps the table
+    # locked by one worker until its commit
+    if ("increment_column" in conf["update"] and conf["update"].get("id_strategy", "max").lower() in ["max", "local"]):
+        raise Exception("--workers can not be used with id_strategy = max or local. Use sequence or default.")
+    
+    print("* Starting {0} workers ...".format(workers))
+    print()
+    
+    # Fork keeps the parsed config and does not run this script again
+    context                     = multiprocessing.get_context("fork")
+    resultqueue                 = context.Queue()
+    rowqueues                   = []
+    processes                   = []
+    
+    for worker_no in range(workers):
+        rowqueue                = context.Queue(maxsize=4)
+        process                 = context.Process(target=import_worker, args=(conf, worker_no + 1, rowqueue, resultqueue))
+        process.daemon          = True # Do not outlive the parent if it crashes
+        process.start()
+        rowqueues.append(rowqueue)
+        processes.append(process)
+    
+    chunks                      = []
+    for worker_no in range(workers):
+        chunks.append([])
+    
+    for rowcnt, csvrow in rows:
+        worker_no               = get_key_partition(get_csv_key(conf, csvrow), workers)
+        chunks[worker_no].append((rowcnt, csvrow))
+        
+        if (len(chunks[worker_no]) >= worker_chunk_rows):
+            rowqueues[worker_no].put(chunks[worker_no])
+            chunks[worker_no]   = []
+    
+    for worker_no in range(workers):
+        if (len(chunks[worker_no]) > 0):
+            rowqueues[worker_no].put(chunks[worker_no])
+        rowqueues[worker_no].put(None)
+    
+    # Merge the results of all workers
+    summary                     = get_empty_summary()
+    errors                      = []
+    for i in range(workers):
+        worker_no, worker_summary, issues, stats, error = resultqueue.get()
+        merge_run_stats(stats)
+        
+        print_summary(worker_summary, "WORKER {0}".format(worker_no))
+        for key in summary:
+            summary[key]        = summary[key] + worker_summary[key]
+        
+        application_issues_list.merge(issues)
+        
+        if (error != None):
+            errors.append(error)
+    
+    for process in processes:
+        process.join()
+    
+    if (len(errors) > 0):
+        raise Exception("; ".join(errors))
+    
+    return summary
+
+# The 'async' engine - reading the CSV file, SELECTs, comparing and
+# writing run at the same time, one chunk after another. Each stage
+# blocking on the database runs in its own thread with its own cursor,
+# so the event loop only has to pass the chunks along.
+def import_csv_rows_async(conf, rows):
+    for column in conf["select"]["keys_list"]:
+        if (column not in conf["column_types"]):
+            raise Exception("Key column '{0}' must also be in [get_database_data].columns_list to use the 'async' engine.".format(column))
+        check_text_key(conf, column, "the 'async' engine")
+    
+    if ("select" in conf["select"]):
+        raise Exception("The 'async' engine can not be used with a custom [get_database_data].select.")
+    
+    chunk_size                  = get_select_int_setting(conf, "lookup_batch_size", lookup_batch_size_default)
+    
+    # The writes are committed once per chunk
+    conf["lookup"]              = "batch"
+    conf["commit_every"]        = 0
+    conf["pending_writes"]      = 0
+    conf["savepoint_set"]       = False
+    conf["write_batch_size"]    = chunk_size
+    conf["write_buffers"]       = {"inserts": [], "updates": []}
+    conf["pending_rows"]        = {}
+    set_id_strategy(conf)
+    
+    if (not debug_mode and not diff_mode):
+        conf["column_sql_types"] = get_column_sql_types(conf)
+    
+    # SELECTs go through a second connection, so they do not wait for
+    # the writes (and do not see them before they are committed)
+    lookup_connection           = get_database_connection(conf)
+    lookup_connection.autocommit = True
+    lookup_cursor               = lookup_connection.cursor()
+    
+    summary                     = get_empty_summary()
+    write_summary               = get_empty_summary()
+    state                       = {"committed_chunk": 0}
+    
+    loop                        = asyncio.new_event_loop()
+    executors                   = []
+    for i in range(3):
+        executors.append(concurrent.futures.ThreadPoolExecutor(max_workers=1))
+    
+    try:
+        pipeline                = run_async_pipeline(conf, loop, executors, get_csv_chunks(conf, rows, chunk_size), lookup_cursor, state, summary, write_summary)
+        loop.run_until_complete(pipeline)
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=True)
+        loop.close()
+        lookup_cursor.close()
+        lookup_connection.close()
+    
+    # Failed writes were counted as inserts/updates by the compare stage
+    for key in summary:
+        summary[key]            = summary[key] + write_summary[key]
+    
+    return summary
+
+
+async def run_async_pipeline(conf, loop, executors, chunks, lookup_cursor, state, summary, write_summary):
+    parse_executor, lookup_executor, write_executor = executors
+    
+    # Each stage has its own copy of the settings, because of
+    # conf["current_csv_line"] and the write buffers
+    lookup_conf                 = dict(conf)
+    write_conf                  = dict(conf)
+    
+    lookup_queue                = asyncio.Queue(maxsize=async_queue_chunks)
+    compare_queue               = asyncio.Queue(maxsize=async_queue_chunks)
+    write_queue                 = asyncio.Queue(maxsize=async_queue_chunks)
+    committed                   = asyncio.Condition()
+    
+    stages                      = [
+        parse_stage(loop, parse_executor, chunks, lookup_queue),
+        lookup_stage(lookup_conf, loop, lookup_executor, lookup_cursor, state, committed, lookup_queue, compare_queue),
+        compare_stage(conf, compare_queue, write_queue, summary),
+        write_stage(write_conf, loop, write_executor, state, committed, write_queue, write_summary)
+    ]
+    
+    tasks                       = []
+    for stage in stages:
+        tasks.append(asyncio.ensure_future(stage))
+    
+    try:
+        await asyncio.gather(*tasks)
+    except:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def parse_stage(loop, executor, chunks, outqueue):
+    while (True):
+        chunk                   = await loop.run_in_executor(executor, next, chunks, None)
+        await outqueue.put(chunk)
+        
+        if (chunk == None):
+            return
+
+
+async def lookup_stage(conf, loop, executor, dbcursor, state, committed, inqueue, outqueue):
+    chunkno                     = 0
+    
+    while (True):
+        chunk                   = await inqueue.get()
+        if (chunk == None):
+            await outqueue.put(None)
+            return
+        
+        chunkno                 = chunkno + 1
+        
+        # Rows with an incomplete key are not tracked by the compare
+        # stage, so their SELECT has to wait for all previous writes
+        for rowcnt, csvrow in chunk:
+            if (get_csv_key(conf, csvrow) == None):
+                async with committed:
+                    await committed.wait_for(lambda: state["committed_chunk"] >= chunkno - 1)
+                break
+        
+        visible                 = state["committed_chunk"]
+        dbrows, keylessrows     = await loop.run_in_executor(executor, lookup_async_chunk, conf, dbcursor, chunk)
+        await outqueue.put((chunk, visible, dbrows, keylessrows))
+
+
+def lookup_async_chunk(conf, dbcursor, chunk):
+    dbrows                      = lookup_db_rows(conf, chunk, dbcursor)
+    keylessrows                 = {}
+    
+    for rowcnt, csvrow in chunk:
+        if (get_csv_key(conf, csvrow) == None):
+            conf["current_csv_line"] = rowcnt
+            keylessrows[rowcnt] = lookup_db_row(conf, csvrow, dbcursor)
+    
+    return dbrows, keylessrows
+
+
+async def compare_stage(conf, inqueue, outqueue, summary):
+    chunkno                     = 0
+    
+    # Rows written by chunks, which were not committed yet when the
+    # current chunk was SELECTed: key -> (chunk number, row)
+    written                     = {}
+    history                     = collections.deque()
+    
+    while (True):
+        item                    = await inqueue.get()
+        if (item == None):
+            await outqueue.put(None)
+            return
+        
+        chunk, visible, dbrows, keylessrows = item
+        chunkno                 = chunkno + 1
+        
+        while (len(history) > 0 and history[0][0] <= visible):
+            writtenno, keys     = history.popleft()
+            for key in keys:
+                if (key in written and written[key][0] == writtenno):
+                    del written[key]
+        
+        writes                  = []
+        keys                    = []
+        for rowcnt, csvrow in chunk:
+            conf["current_csv_line"] = rowcnt
+            summary["total"]    = summary["total"] + 1
+            key                 = get_csv_key(conf, csvrow)
+            
+            if (key == None):
+                dbrow           = keylessrows[rowcnt]
+            elif (key in written):
+                dbrow           = written[key][1]
+            else:
+                dbrow           = dbrows.get(key)
+            
+            action              = get_csv_row_action(conf, rowcnt, csvrow, dbrow, summary)
+            
+            if (debug_mode or diff_mode):
+                continue
+            
+            if (action == "skips"):
+                row_print(rowcnt, "skipping", conf["csv"]["fields_list"], csvrow)
+                summary["skips"]= summary["skips"] + 1
+                continue
+            
+            writes.append((rowcnt, csvrow, action))
+            if (key != None):
+                written[key]    = (chunkno, get_csv_db_row(conf, csvrow))
+                keys.append(key)
+        
+        history.append((chunkno, keys))
+        await outqueue.put((chunkno, writes))
+
+
+async def write_stage(conf, loop, executor, state, committed, inqueue, summary):
+    while (True):
+        item                    = await inqueue.get()
+        if (item == None):
+            return
+        
+        chunkno, writes         = item
+        if (len(writes) > 0):
+            await loop.run_in_executor(executor, write_async_chunk, conf, writes, summary)
+        
+        async with committed:
+            state["committed_chunk"] = chunkno
+            committed.notify_all()
+
+
+def write_async_chunk(conf, writes, summary):
+    for rowcnt, csvrow, action in writes:
+        conf["current_csv_line"] = rowcnt
+        key                     = get_csv_key(conf, csvrow)
+        
+        # Same key again (or a key which can not be tracked) - the
+        # buffered queries go first
+        if (len(conf["pending_rows"]) > 0 and (key == None or key in conf["pending_rows"])):
+            flush_writes(conf, summary)
+        
+        increment_column_val    = None
+        if (action == "inserts"):
+            increment_column_val = get_next_id(conf)
+            debug_print("next id: {0}", increment_column_val)
+            sql, params         = get_insert_query(conf, csvrow, increment_column_val)
+        else:
+            sql, params         = get_update_query(conf, csvrow)
+        
+        debug_print("EXECUTING: {0} {1}", sql, params)
+        buffer_write(conf, summary, action, csvrow, increment_column_val)
+    
+    flush_writes(conf, summary)
+    
+    debug_print("COMMIT: {0} queries", len(writes))
+    commit(conf)
+    conf["pending_writes"]      = 0
+
+
+# The 'upsert' engine - no SELECTs at all. Each batch of CSV rows is one
+# INSERT ... ON CONFLICT DO UPDATE, which changes only the rows where at
+# least one "columns_list" value differs. RETURNING (xmax = 0) tells the
+# new rows from the updated ones and the rows not returned were skipped.
+def import_csv_rows_upsert(conf, rows):
+    if (debug_mode or diff_mode):
+        raise Exception("The 'upsert' engine does not read the rows before writing them, so it can not be used in DEBUG or DIFF MODE.")
+    
+    set_id_strategy(conf)
+    if (conf["id_strategy"] not in ["sequence", "default"]):
+        raise Exception("The 'upsert' engine needs [update_database_data].id_strategy = sequence or default.")
+    
+    # nextval() runs for every row sent, also for the ones which end up
+    # in ON CONFLICT - a 4 byte ID column soon runs out
+    if ("increment_column" in conf["update"]):
+        sqltype                 = get_column_sql_types(conf).get(conf["update"]["increment_column"])
+        if (sqltype in ["smallint", "integer"]):
+            print("* WARNING: The 'upsert' engine uses up an ID for every CSV row. Column '{0}' is {1}, bigint is safer.".format(conf["update"]["increment_column"], sqltype))
+    
+    batch_size                  = get_update_int_setting(conf, "write_batch_size", upsert_batch_size_default)
+    conf["commit_every"]        = get_commit_every(conf)
+    conf["pending_writes"]      = 0
+    conf["savepoint_set"]       = False
+    conf["upsert_query"]        = get_upsert_query(conf)
+    
+    summary                     = get_empty_summary()
+    batch                       = []
+    keys                        = {}
+    
+    for rowcnt, csvrow in rows:
+        conf["current_csv_line"] = rowcnt
+        key                     = get_csv_key(conf, csvrow)
+        
+        if (key == None):
+            raise Exception("CSV Line: {0}; Blank value for a key column. All values for key columns must not be blank. Invalid CSV file.".format(rowcnt))
+        
+        # ON CONFLICT can not change the same row twice in one query
+        if (key in keys or len(batch) >= batch_size):
+            execute_upsert(conf, summary, batch)
+            batch               = []
+            keys                = {}
+        
+        batch.append((rowcnt, csvrow))
+        keys[key]               = True
+    
+    if (len(batch) > 0):
+        execute_upsert(conf, summary, batch)
+    
+    commit_writes(conf)
+    
+    return summary
+
+
+# Needs a primary key or a unique index on exactly "keys_list"
+def get_upsert_query(conf):
+    db                          = conf["db"]["type"]
+    insert_columns              = [column[0] for column in conf["row_plan"]["insert"]]
+    template                    = [sql_placeholder] * len(insert_columns)
+    
+    if (conf["id_strategy"] == "sequence"):
+        insert_columns.append(conf["update"]["increment_column"])
+        template.append("nextval('{0}')".format(conf["id_sequence"]))
+    
+    set_clause                  = []
+    for column in conf["update"]["columns_list"]:
+        set_clause.append("{0} = excluded.{0}".format(column))
+    
+    sql                         = "insert into {0} as t ({1}) values %s on conflict ({2}) do update set {3} where {4} returning (xmax = 0);".format(conf["db"][db]["table"], ', '.join(insert_columns), ', '.join(conf["select"]["keys_list"]), ', '.join(set_clause), get_staging_distinct(conf, "excluded"))
+    
+    return sql, "({0})".format(', '.join(template))
+
+
+def execute_upsert(conf, summary, batch):
+    sql, template               = conf["upsert_query"]
+    plan_columns                = conf["row_plan"]["insert"]
+    backend                     = conf["backend"]
+    summary["total"]            = summary["total"] + len(batch)
+    
+    values                      = []
+    for rowcnt, csvrow in batch:
+        values.append(get_plan_values(plan_columns, csvrow))
+    
+    debug_print("EXECUTING: {0} ({1} rows)", sql, len(values))
+    
+    if (conf["commit_every"] == 1):
+        results                 = psycopg2.extras.execute_values(cursor, sql, values, template=template, page_size=len(values), fetch=True)
+        add_upsert_results(summary, len(batch), results)
+        commit(conf)
+        return
+    
+    if (not conf["savepoint_set"]):
+        backend.set_savepoint(cursor)
+        conf["savepoint_set"]   = True
+    
+    try:
+        results                 = psycopg2.extras.execute_values(cursor, sql, values, template=template, page_size=len(values), fetch=True)
+        backend.execute_savepoint(cursor, "", None)
+    except Exception as e:
+        # Find the bad row(s) - same query, but one row at a time
+        backend.rollback_savepoint(cursor)
+        debug_print("Batch failed, executing row by row: {0}", str(e).strip())
+        
+        for (rowcnt, csvrow), rowvalues in zip(batch, values):
+            conf["current_csv_line"] = rowcnt
+            try:
+                results         = psycopg2.extras.execute_values(cursor, sql, [rowvalues], template=template, fetch=True)
+                backend.execute_savepoint(cursor, "", None)
+            except Exception as e:
+                backend.rollback_savepoint(cursor)
+                add_application_issue(sql_issue, rowcnt, " " + str(e).strip())
+                print("[{0}] FAILED: {1}".format(rowcnt, str(e).strip()))
+                summary["errors"] = summary["errors"] + 1
+                continue
+            
+            add_upsert_results(summary, 1, results)
+            conf["pending_writes"] = conf["pending_writes"] + 1
+        
+        if (conf["commit_every"] > 1 and conf["pending_writes"] >= conf["commit_every"]):
+            commit_writes(conf)
+        return
+    
+    add_upsert_results(summary, len(batch), results)
+    conf["pending_writes"]      = conf["pending_writes"] + len(batch)
+    if (conf["commit_every"] > 1 and conf["pending_writes"] >= conf["commit_every"]):
+        commit_writes(conf)
+
+
+# One (inserted,) row for each inserted or updated CSV row
+def add_upsert_results(summary, count, results):
+    inserts                     = 0
+    for inserted, in results:
+        if (inserted):
+            inserts             = inserts + 1
+    
+    summary["inserts"]          = summary["inserts"] + inserts
+    summary["updates"]          = summary["updates"] + len(results) - inserts
+    summary["skips"]            = summary["skips"] + count - len(results)
+
+
+def print_summary(summary, title="SUMMARY"):
+    print()
+    print()
+    print(get_summary_line(summary, title))
+    diff_print("total differences found:{0}", summary["inserts"]+summary["updates"])
+
+
+def get_summary_line(summary, title):
+    if (summary["errors"] > 0):
+        return "[{0}] total:{1}, inserts:{2}, updates:{3}, skips:{4}, errors:{5}".format(title, summary["total"], summary["inserts"], summary["updates"], summary["skips"], summary["errors"])
+    
+    return "[{0}] total:{1}, inserts:{2}, updates:{3}, skips:{4}".format(title, summary["total"], summary["inserts"], summary["updates"], summary["skips"])
+
+
+def get_engine(conf):
+    engine                      = "row"
+    if ("engine" in conf["update"]):
+        engine                  = conf["update"]["engine"].lower()
+    
+    if (engine not in supported_engines):
+        raise Exception("Unknown [update_database_data].engine: {0}. Supported: {1}".format(engine, ', '.join(supported_engines)))
+    
+    if (engine in ["copy", "async", "upsert"] and conf["db"]["type"] != "postgresql"):
+        raise Exception("The '{0}' engine is supported on PostgreSQL only.".format(engine))
+    
+    if (engine != "row" and conf["update"].get("compare", "row").lower() != "row"):
+        raise Exception("[update_database_data].compare works with the 'row' engine only.")
+    
+    return engine
+
+
+def import_csv_file(conf, fn):
+    engine                      = get_engine(conf)
+    conf["engine"]              = engine
+    conf["checkpoint"]          = get_checkpoint(conf, fn)
+    debug_print("Engine: {0}", engine)
+    
+    conf["diff_writer"]         = get_diff_writer(conf)
+    try:
+        if (engine == "copy"):
+            return copy_csv_file(conf, fn)
+        
+        return read_csv_file(conf, fn)
+    finally:
+        if (conf["diff_writer"] != None):
+            conf["diff_writer"].close()
+
+
+# --diff-file: every difference found goes to a CSV (or Parquet) file,
+# one line for each differing column of a row - or for each
+# "columns_list" column of a new row - with the key values and the CSV
+# line number. Written while the import runs, nothing is kept in memory
+# (except up to diff_parquet_rows lines for Parquet).
+class DiffWriter:
+    def __init__(self, conf, fn):
+        self.fn                 = fn
+        self.parquet            = fn.lower().endswith(".parquet")
+        self.rows               = []
+        self.columns            = ["STATUS", "LINE"]
+        for column in conf["select"]["keys_list"]:
+            self.columns.append("KEY:{0}".format(column))
+        self.columns            = self.columns + ["DATABASE_COLUMN", "DATABASE_VALUE", "CSV_VALUE"]
+        
+        if (self.parquet):
+            fields              = []
+            for column in self.columns:
+                fields.append((column, pyarrow.int64() if column == "LINE" else pyarrow.string()))
+            self.schema         = pyarrow.schema(fields)
+            self.writer         = pyarrow.parquet.ParquetWriter(fn, self.schema)
+        else:
+            self.fh             = open(fn, "w", newline="", buffering=read_buffer_size_default)
+            self.writer         = csv.writer(self.fh)
+            self.writer.writerow(self.columns)
+    
+    def add(self, status, rowcnt, key, differences):
+        key                     = [get_diff_value(val) for val in key]
+        for colname, dbval, csvval in differences:
+            row                 = [status, rowcnt] + key + [colname, get_diff_value(dbval), get_diff_value(csvval)]
+            if (not self.parquet):
+                self.writer.writerow(row)
+                continue
+            
+            self.rows.append(row)
+            if (len(self.rows) >= diff_parquet_rows):
+                self.flush()
+    
+    def flush(self):
+        if (not self.parquet or len(self.rows) == 0):
+            return
+        
+        arrays                  = []
+        for i in range(len(self.columns)):
+            arrays.append(pyarrow.array([row[i] for row in self.rows], type=self.schema.field(i).type))
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        self.rows               = []
+    
+    def close(self):
+        if (self.parquet):
+            self.flush()
+            self.writer.close()
+        else:
+            self.fh.close()
+        
+        print("* Differences written to: {0}".format(self.fn))
+
+
+# Text, as in the CSV file - None stays empty (null in Parquet)
+def get_diff_value(val):
+    if (val == None):
+        return None
+    
+    return str(val)
+
+
+def get_diff_writer(conf):
+    if (diff_file == None):
+        return None
+    
+    if (workers > 1):
+        raise Exception("--diff-file can not be used with --workers.")
+    
+    if (conf["engine"] == "upsert"):
+        raise Exception("--diff-file can not be used with the 'upsert' engine.")
+    
+    if (diff_file.lower().endswith(".parquet") and pyarrow == None):
+        raise Exception("Writing .parquet files needs the 'pyarrow' module: pip install pyarrow")
+    
+    return DiffWriter(conf, diff_file)
+
+
+# File-like object, feeding the CSV rows to COPY ... FROM STDIN without
+# keeping the whole file in memory
+class CsvCopyStream:
+    def __init__(self, rows):
+        self.rows               = rows
+        self.buffer             = ""
+        self.finished           = False
+    
+    def fill(self, size):
+        fh                      = StringIO()
+        writer                  = csv.writer(fh, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        
+        while (not self.finished and (size < 0 or len(self.buffer) + fh.tell() < size)):
+            for i in range(copy_buffer_rows):
+                try:
+                    writer.writerow(next(self.rows))
+                except StopIteration:
+                    self.finished = True
+                    break
+        
+        self.buffer             = self.buffer + fh.getvalue()
+    
+    def read(self, size=-1):
+        self.fill(size)
+        
+        if (size < 0 or size >= len(self.buffer)):
+            data                = self.buffer
+            self.buffer         = ""
+        else:
+            data                = self.buffer[:size]
+            self.buffer         = self.buffer[size:]
+        
+        return data
+    
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def get_staging_columns(conf):
+    return list(conf["db2csv_fields_map"].keys())
+
+
+def get_staging_rows(conf, rows, columns):
+    indexes                     = []
+    for column in columns:
+        indexes.append(conf["index_map"][conf["db2csv_fields_map"][column]])
+    
+    for rowcnt, csvrow in rows:
+        if (get_csv_key(conf, csvrow) == None):
+            # Same check as the row engine, but a partial key can not be
+            # matched set-based, so such rows are reported and left out
+            if (len(get_predicate(conf, csvrow)[0]) == 0):
+                raise Exception("CSV Line: {0}; Blank value for a key column. All values for key columns must not be blank. Invalid CSV file.".format(rowcnt))
+            add_application_issue(csv_file_issue, rowcnt, " Row not imported by the copy engine, because of empty key column.")
+            continue
+        
+        stagingrow              = [rowcnt]
+        for index in indexes:
+            stagingrow.append(csvrow[index])
+        
+        yield stagingrow
+
+
+def get_staging_join(conf):
+    predicate                   = []
+    for column in conf["select"]["keys_list"]:
+        predicate.append("t.{0} = s.{0}".format(column))
+    
+    return ' and '.join(predicate)
+
+
+def get_staging_distinct(conf, source="s"):
+    # Same rules as get_row_differences(), but in SQL
+    predicate                   = []
+    for column in conf["update"]["columns_list"]:
+        if ("null_equals_to_empty" in conf["select"] and conf["column_types"][column] == "varchar"):
+            predicate.append("coalesce(t.{0}, '') is distinct from {1}.{0}".format(column, source))
+        else:
+            predicate.append("t.{0} is distinct from {1}.{0}".format(column, source))
+    
+    return ' or '.join(predicate)
+
+
+def get_staging_queries(conf, columns):
+    db                          = conf["db"]["type"]
+    table                       = conf["db"][db]["table"]
+    join                        = get_staging_join(conf)
+    distinct                    = get_staging_distinct(conf)
+    
+    # Varchars stay as they are, empty values of any other type are NULL
+    force_null                  = []
+    for column in columns:
+        if (conf["column_types"][column] == "other"):
+            force_null.append(column)
+    
+    copy_options                = "format csv"
+    if (len(force_null) > 0):
+        copy_options            = "{0}, force_null ({1})".format(copy_options, ', '.join(force_null))
+    
+    set_clause                  = []
+    for column in conf["update"]["columns_list"]:
+        set_clause.append("{0} = s.{0}".format(column))
+    
+    insert_columns              = list(columns)
+    insert_values               = []
+    for column in columns:
+        insert_values.append("s.{0}".format(column))
+    
+    if (conf["id_strategy"] != "default"):
+        increment_column        = conf["update"]["increment_column"]
+        insert_columns.append(increment_column)
+        if (conf["id_strategy"] == "sequence"):
+            insert_values.append("nextval('{0}')".format(conf["id_sequence"]))
+        else:
+            insert_values.append("(select coalesce(max({0}), 0) from {1}) + row_number() over (order by s.csv_line)".format(increment_column, table))
+    
+    target_columns              = []
+    staged_columns              = []
+    for column in columns:
+        target_columns.append("t.{0}".format(column))
+        staged_columns.append("s.{0}".format(column))
+    
+    queries                     = {
+        "create"    : "create temporary table {0} as select {1} from {2} with no data;".format(staging_table, ', '.join(columns), table),
+        "line"      : "alter table {0} add column csv_line bigint;".format(staging_table),
+        "copy"      : "copy {0} (csv_line, {1}) from stdin with ({2});".format(staging_table, ', '.join(columns), copy_options),
+        "analyze"   : "analyze {0};".format(staging_table),
+        # Same key more than once in the CSV - the last one wins
+        "dedup"     : "delete from {0} t using {0} s where {1} and s.csv_line > t.csv_line;".format(staging_table, join),
+        "lock"      : "lock table {0} in share row exclusive mode;".format(table),
+        "preview"   : "select s.csv_line, t.ctid is null, {0}, {1} from {2} s left join {3} t on {4} where t.ctid is null or {5} order by s.csv_line;".format(', '.join(target_columns), ', '.join(staged_columns), staging_table, table, join, distinct),
+        "update"    : "update {0} t set {1} from {2} s where {3} and ({4});".format(table, ', '.join(set_clause), staging_table, join, distinct),
+        "insert"    : "insert into {0} ({1}) select {2} from {3} s where not exists (select 1 from {0} t where {4});".format(table, ', '.join(insert_columns), ', '.join(insert_values), staging_table, join),
+        "drop"      : "drop table {0};".format(staging_table)
+    }
+    
+    return queries
+
+
+def execute_staging_query(sql):
+    debug_print("EXECUTING: {0}", sql)
+    cursor.execute(sql)
+    debug_print("Affected rows: {0}", cursor.rowcount)
+    
+    return cursor.rowcount
+
+
+def preview_staging_changes(conf, columns, sql, summary):
+    plan                        = conf["row_plan"]
+    fields                      = [conf["db2csv_fields_map"][column] for column in columns]
+    
+    debug_print("EXECUTING: {0}", sql)
+    cursor.execute(sql)
+    
+    for result in cursor:
+        rowcnt                  = result[0]
+        dbrow                   = result[2:2 + len(columns)]
+        stagingrow              = list(result[2 + len(columns):])
+        
+        if (result[1]):
+            row_print(rowcnt, "inserting", fields, stagingrow)
+            diff_print("\"NEW\",\"\",\"\",\"{0}\",\"{1}\"", rowcnt, stagingrow)
+            if (conf["diff_writer"] != None):
+                conf["diff_writer"].add("NEW", rowcnt, get_row_values(stagingrow, plan["staging_keys"]), get_new_row_values(stagingrow, plan["staging_compare"]))
+            summary["inserts"]  = summary["inserts"] + 1
+            continue
+        
+        differences             = get_row_differences(conf, stagingrow, dbrow, plan["staging_compare"])
+        if (len(differences) == 0):
+            continue
+        
+        colname, dbval, csvval  = differences[0]
+        row_print(rowcnt, "updating", fields, stagingrow)
+        diff_print("\"diff\",\"{0}\",\"{1}\",\"{2}\",\"{3}\"", colname, dbval, rowcnt, stagingrow)
+        if (conf["diff_writer"] != None):
+            conf["diff_writer"].add("diff", rowcnt, get_row_values(stagingrow, plan["staging_keys"]), differences)
+        summary["updates"]      = summary["updates"] + 1
+
+
+def copy_csv_file(conf, fn):
+    columns                     = get_staging_columns(conf)
+    set_id_strategy(conf)
+    queries                     = get_staging_queries(conf, columns)
+    
+    conf["current_csv_line"]    = 0
+    store                       = get_fingerprint_store(conf)
+    
+    try:
+        summary                 = copy_csv_rows(conf, fn, columns, queries, store)
+    finally:
+        if (store != None):
+            store.close()
+    
+    print_summary(summary)
+    return summary
+
+
+def copy_csv_rows(conf, fn, columns, queries, store):
+    summary                     = get_empty_summary()
+    
+    with open_csv_file(conf, fn) as fh:
+        rows                    = get_csv_file_rows(conf, fn, fh)
+        if (store != None):
+            rows                = get_changed_rows(conf, rows, store, get_empty_summary())
+        
+        diff_print("\"STATUS\",\"DATABASE_COLUMN\",\"DATABASE_VALUE\",\"LINE\",\"{0}\"", os.path.basename(fn))
+        
+        execute_staging_query(queries["create"])
+        execute_staging_query(queries["line"])
+        
+        debug_print("EXECUTING: {0}", queries["copy"])
+        try:
+            cursor.copy_expert(queries["copy"], CsvCopyStream(get_staging_rows(conf, rows, columns)))
+        finally:
+            rows.close()
+    
+    summary["total"]            = conf["current_csv_line"]
+    
+    execute_staging_query(queries["analyze"])
+    execute_staging_query(queries["dedup"])
+    
+    if (verbose_mode or debug_mode or diff_mode):
+        preview_staging_changes(conf, columns, queries["preview"], summary)
+    
+    debug_print("EXECUTING: {0}", queries["update"])
+    debug_print("EXECUTING: {0}", queries["insert"])
+    if (not debug_mode and not diff_mode):
+        if (conf["id_strategy"] == "local"):
+            execute_staging_query(queries["lock"])
+        summary["updates"]      = execute_staging_query(queries["update"])
+        summary["inserts"]      = execute_staging_query(queries["insert"])
+        summary["skips"]        = summary["total"] - summary["inserts"] - summary["updates"]
+    else:
+        debug_print("SQL query not executed, because of DEBUG_MODE being enabled.")
+    
+    execute_staging_query(queries["drop"])
+    connection.commit()
+    
+    if (store != None):
+        save_fingerprint_store(store)
+    
+    return summary
+
+
+# ---------- Batch mode
+# A directory or a glob pattern instead of one CSV file. Each INI file is
+# read once, the connections stay open for the next file and up to
+# --jobs files are imported at the same time, each in its own process.
+
+def is_csv_batch(fn):
+    return fn != "-" and (os.path.isdir(fn) or re.search(r'[*?\[]', fn) != None)
+
+
+def get_batch_files(pattern):
+    files                       = []
+    
+    if (os.path.isdir(pattern)):
+        for name in os.listdir(pattern):
+            csvname             = name
+            extension           = get_compressed_extension(name)
+            if (extension != None):
+                csvname         = name[:-len(extension)]
+            if (csvname.lower().endswith(".csv")):
+                files.append(os.path.join(pattern, name))
+    else:
+        files                   = glob.glob(pattern)
+    
+    return sorted(fn for fn in files if os.path.isfile(fn))
+
+
+# Same as the INI of a single CSV file: mycsv.csv(.gz) uses mycsv.ini
+def get_csv_conffn(fn):
+    conffn                      = "{0}/{1}".format(confpath, os.path.basename(fn))
+    extension                   = get_compressed_extension(fn)
+    if (extension != None):
+        conffn                  = conffn[:-len(extension)]
+    
+    return re.sub(r'\.[A-z]+$', '', conffn) + ".ini"
+
+
+def import_csv_batch(pattern, conffn, defaultsconf):
+    files                       = get_batch_files(pattern)
+    if (len(files) == 0):
+        raise Exception("No CSV files found: {0}".format(pattern))
+    
+    if (resume_mode):
+        raise Exception("resume can not be used with more than one CSV file.")
+    
+    if (jobs > 1 and (workers > 1 or parsers > 1)):
+        raise Exception("--jobs can not be used with --workers or --parsers.")
+    
+    tasks                       = []
+    inicount                    = {}
+    for fn in files:
+        fileconffn              = conffn
+        if (fileconffn == None):
+            fileconffn          = get_csv_conffn(fn)
+        
+        get_batch_conf(fn, fileconffn, defaultsconf)
+        tasks.append((fn, fileconffn, defaultsconf))
+        inicount[fileconffn]    = inicount.get(fileconffn, 0) + 1
+    
+    if (jobs > 1):
+        check_batch_confs(inicount)
+    
+    print("* {0} CSV files, {1} INI files, {2} at a time ...".format(len(files), len(batch_confs), jobs))
+    print()
+    
+    if (jobs > 1):
+        # Fork keeps the parsed configs
+        context                 = multiprocessing.get_context("fork")
+        pool                    = context.Pool(min(jobs, len(tasks)))
+        results                 = pool.imap_unordered(import_batch_file, tasks)
+    else:
+        pool                    = None
+        results                 = map(import_batch_file, tasks)
+    
+    summary                     = get_empty_summary()
+    summaries                   = {}
+    failed                      = []
+    
+    try:
+        for result in results:
+            summary             = add_batch_result(result, summary, failed)
+            summaries[result[0]]= (result[1], result[4])
+    finally:
+        if (pool != None):
+            pool.close()
+            pool.join()
+        close_connection_pool()
+    
+    print()
+    print()
+    for fn in files:
+        file_summary, error     = summaries[fn]
+        if (error != None):
+            print("[{0}] FAILED: {1}".format(fn, error))
+        else:
+            print(get_summary_line(file_summary, fn))
+    
+    print_summary(summary, "ALL FILES")
+    return summary, failed
+
+
+# Screen output, summary, issues and statistics of one file of the batch
+def add_batch_result(result, summary, failed):
+    fn, file_summary, issues, stats, error, output = result
+    if (output != None):
+        print(output, end="")
+    
+    merge_run_stats(stats)
+    
+    application_issues_list.merge(issues, os.path.basename(fn))
+    
+    if (error != None):
+        print("[{0}] FAILED: {1}".format(fn, error))
+        failed.append(fn)
+    sys.stdout.flush()
+    
+    return add_summaries(summary, file_summary)
+
+
+# Read once - and again only if the INI file was changed
+def get_batch_conf(fn, conffn, defaultsconf):
+    check_files(fn, conffn, defaultsconf)
+    
+    mtime                       = os.path.getmtime(conffn)
+    if (conffn not in batch_confs or batch_confs[conffn][0] != mtime):
+        batch_confs[conffn]     = (mtime, get_conf(conffn, defaultsconf))
+    
+    return batch_confs[conffn][1]
+
+
+# Files imported at the same time must not share what is kept per INI
+# file or per table
+def check_batch_confs(inicount):
+    for conffn in batch_confs:
+        check_batch_conf(conffn, batch_confs[conffn][1], inicount[conffn])
+
+
+def check_batch_conf(conffn, conf, inicount):
+    update                      = conf["update"]
+    
+    if (inicount > 1):
+        for name in ["incremental", "checkpoint"]:
+            if (name in update and update[name].lower() == "yes"):
+                raise Exception("{0}: '{1} = yes' needs one CSV file per INI file with --jobs.".format(conffn, name))
+    
+    if ("increment_column" in update and update.get("id_strategy", "max").lower() in ["max", "local"]):
+        raise Exception("{0}: --jobs can not be used with id_strategy = max or local. Use sequence or default.".format(conffn))
+
+
+# One CSV file of the batch, in a process of the pool (or in this one
+# with --jobs 1). With more jobs the screen output is collected and
+# printed by the parent when the file is done, so it is not mixed up.
+def import_batch_file(task):
+    global connection
+    global cursor
+    global application_issues_list
+    global run_stats
+    
+    fn, conffn, defaultsconf    = task
+    conf                        = None
+    issues                      = application_issues_list
+    stats                       = run_stats
+    application_issues_list     = ApplicationIssues()
+    set_run_stats()
+    
+    stdout                      = sys.stdout
+    if (jobs > 1):
+        sys.stdout              = StringIO()
+    
+    summary                     = get_empty_summary()
+    error                       = None
+    
+    try:
+        print("PARSING: {0}".format(fn))
+        print()
+        
+        conf                    = copy.deepcopy(get_batch_conf(fn, conffn, defaultsconf))
+        
+        # In watch mode the INI files are seen one by one. Files with the
+        # same INI file are not imported at the same time (see
+        # watch_csv_dir), so "incremental" and "checkpoint" are fine.
+        if (watch_mode and jobs > 1):
+            check_batch_conf(conffn, conf, 1)
+        
+        connection              = get_pooled_connection(conf)
+        cursor                  = connection.cursor()
+        summary                 = import_csv_file(conf, fn)
+        
+        # The next file gets its own prepared statements
+        if (len(conf["prepared"]) > 0):
+            cursor.execute("deallocate all;")
+        cursor.close()
+        
+        # Nothing is left open in the pooled connection - what was not
+        # committed (DEBUG or DIFF MODE, the last lookups) is not wanted
+        connection.rollback()
+    except Exception as e:
+        error                   = str(e).strip()
+        if (conf != None):
+            drop_pooled_connection(conf)
+    finally:
+        output                  = None
+        if (jobs > 1):
+            output              = sys.stdout.getvalue()
+            sys.stdout          = stdout
+    
+    result                      = (fn, summary, application_issues_list, run_stats, error, output)
+    application_issues_list     = issues
+    run_stats                   = stats
+    
+    return result
+
+
+# ---------- Watch mode
+# --watch: the directory is checked every watch_poll_seconds (or at once
+# when a file is closed, if the "inotify_simple" module is installed)
+# and each new CSV file is imported as soon as it is complete - with the
+# same INI cache, connections and --jobs limit as the batch mode - and
+# moved to done/ or failed/. Runs until Ctrl+C or SIGTERM.
+
+def watch_csv_dir(path, conffn, defaultsconf):
+    if (not os.path.isdir(path)):
+        raise Exception("--watch needs a directory: {0}".format(path))
+    
+    if (resume_mode):
+        raise Exception("resume can not be used with --watch.")
+    
+    if (jobs > 1 and (workers > 1 or parsers > 1)):
+        raise Exception("--jobs can not be used with --workers or --parsers.")
+    
+    for subdir in ["done", "failed"]:
+        if (not os.path.isdir(os.path.join(path, subdir))):
+            os.mkdir(os.path.join(path, subdir))
+    
+    watcher                     = None
+    if (inotify_simple != None):
+        watcher                 = inotify_simple.INotify()
+        watcher.add_watch(path, inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO)
+    
+    print("* Watching {0}, {1} file(s) at a time - Ctrl+C to stop ...".format(path, jobs))
+    print()
+    sys.stdout.flush()
+    
+    pool                        = None
+    if (jobs > 1):
+        context                 = multiprocessing.get_context("fork")
+        pool                    = context.Pool(jobs, initializer=ignore_stop_signals)
+    
+    signal.signal(signal.SIGINT, stop_watching)
+    signal.signal(signal.SIGTERM, stop_watching)
+    
+    summary                     = get_empty_summary()
+    failed                      = []
+    sizes                       = {}
+    closed                      = {}
+    queued                      = collections.deque()
+    running                     = {}
+    
+    try:
+        while (not watch_stopping):
+            busy                = set(queued) | set(running.keys())
+            for fn in get_ready_files(path, sizes, closed, busy):
+                queued.append(fn)
+            closed              = {}
+            
+            # One file per INI file at a time - they share the
+            # fingerprints and the checkpoint file. The others wait.
+            for fn in list(queued):
+                if (len(running) >= jobs or watch_stopping):
+                    break
+                
+                fileconffn      = conffn
+                if (fileconffn == None):
+                    fileconffn  = get_csv_conffn(fn)
+                
+                task            = (fn, fileconffn, defaultsconf)
+                if (pool == None):
+                    queued.remove(fn)
+                    summary     = finish_watched_file(path, import_batch_file(task), summary, failed)
+                elif (fileconffn not in [running[name][0] for name in running]):
+                    queued.remove(fn)
+                    running[fn] = (fileconffn, pool.apply_async(import_batch_file, (task,)))
+            
+            for fn in list(running.keys()):
+                if (running[fn][1].ready()):
+                    summary     = finish_watched_file(path, running.pop(fn)[1].get(), summary, failed)
+            
+            if (watcher == None):
+                time.sleep(watch_poll_seconds)
+                continue
+            
+            for event in watcher.read(timeout=watch_poll_seconds * 1000):
+                closed[os.path.join(path, event.name)] = True
         
-    if (verbose_mode or debug_mode):
-        if (s == ""):
-            print()
-        else:
-            print("DEBUG: {0}".format(s))
+        print()
+        print("* Stopping - waiting for {0} file(s) being imported ...".format(len(running)))
+        sys.stdout.flush()
+    finally:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        
+        for fn in list(running.keys()):
+            summary             = finish_watched_file(path, running.pop(fn)[1].get(), summary, failed)
+        
+        if (pool != None):
+            pool.close()
+            pool.join()
+        if (watcher != None):
+            watcher.close()
+        close_connection_pool()
+    
+    print_summary(summary, "ALL FILES")
+    return summary, failed
 
 
-def diff_print(s):
-    if (not diff_mode):
-        return
-    print(s)
+# Not an exception - the file being imported (also with --jobs 1, in
+# this process) is finished first, then no new file is started
+def stop_watching(signum, frame):
+    global watch_stopping
+    
+    watch_stopping              = True
 
 
-def regular_print(s):
-    if (not diff_mode):
-        print(s)
+# Ctrl+C and "kill" of the whole process group (or a service stop) reach
+# the pool processes too - they finish their file and wait for the parent
+def ignore_stop_signals():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
 
 
-def add_application_issue(category, issuemsg):
-    if (category not in application_issues_list):
-        application_issues_list[category] = []
+# A file is complete when it was closed after writing (inotify) or when
+# its size and time did not change since the last look
+def get_ready_files(path, sizes, closed, busy):
+    ready                       = []
+    current                     = {}
     
-    application_issues_list[category].append("[{0}]{1}".format(category, issuemsg))
-
-
-def get_all_application_issues():
-    issues                      = []
-    for cat in application_issues_list:
-        issues                  = issues + application_issues_list[cat]
+    for fn in get_batch_files(path):
+        if (fn in busy):
+            continue
+        
+        stat                    = os.stat(fn)
+        current[fn]             = (stat.st_size, stat.st_mtime)
+        if (fn in closed or sizes.get(fn) == current[fn]):
+            ready.append(fn)
     
-    return issues
+    sizes.clear()
+    sizes.update(current)
+    
+    return ready
 
 
-def print_all_application_issues():
-    issues                      = get_all_application_issues()
+def finish_watched_file(path, result, summary, failed):
+    fn                          = result[0]
+    error                       = result[4]
+    summary                     = add_batch_result(result, summary, failed)
     
-    if (len(issues) > 0):
-        print()
-        print("LIST OF ALL APPLICATION ISSUES")
-        print("------------------------------")
+    subdir                      = "done"
+    if (error != None):
+        subdir                  = "failed"
     
-    for imsg in issues:
-        print(imsg)
+    os.replace(fn, os.path.join(path, subdir, os.path.basename(fn)))
+    if (error == None):
+        print(get_summary_line(result[1], fn))
+        sys.stdout.flush()
+    
+    return summary
 
 
-def get_database_connection(conf):
+def get_connection_key(conf):
     db                          = conf["db"]["type"]
-    dhost                       = conf["db"][db]["host"]
-    dport                       = conf["db"][db]["port"]
-    dname                       = conf["db"][db]["name"]
-    duser                       = conf["db"][db]["user"]
-    dpass                       = conf["db"][db]["pass"]
-    
-    print("* Connecting to database '{0}' (*{1}* {2}:{3}) ...".format(dname, db, dhost, dport))
-    print()
-    
-    if (db == 'postgresql'):
-        return psycopg2.connect(host=dhost, port=dport, database=dname, user=duser, password=dpass)
-    
-    # Remove the comment '#' from next lines, if you are using any of these
-    # databases. Don't forget to install the connector module !!
-    
-    #if (db == 'mysql'):
-    #    return mysql.connector.connect(host=dhost, port=dport, database=dname, user=duser, password=dpass)
-    #if (db == 'oracle'):
-    #    return cx_Oracle.connector.connect(host=dhost, port=dport, database=dname, user=duser, password=dpass)
-    #if (db == 'sqlserver'):
-    #    return pymssql.connector.connect(host=dhost, port=dport, database=dname, user=duser, password=dpass)
+    return (db, conf["db"][db].get("host"), conf["db"][db].get("port"), conf["db"][db]["name"], conf["db"][db].get("user"))
 
 
-# Any key name ending in "_list" will be resolved as a CSV value and returned as list.
-# Any other value will be returned as is.
-def get_ini_value(name, sval):
-    match                       = re.search(r'_list$', name)
-    if not match:
-        return sval.strip() # If not a list, return as is
-    
-    fh                          = StringIO(sval)
-    reader                      = csv.reader(fh, delimiter=',', quotechar='"') # INI values format
-    l                           = list(reader)
-    result_list                 = []
-    
-    # Trimming spaces
-    for val in l[0]:
-        result_list.append(val.strip())
+def get_pooled_connection(conf):
+    key                         = get_connection_key(conf)
+    if (key in connection_pool and not connection_pool[key].closed):
+        return connection_pool[key]
     
-    return result_list # l[0] # We need just the first element
+    connection_pool[key]        = get_database_connection(conf)
+    return connection_pool[key]
 
 
-def get_ini_section(sdict):
-    for key in sdict:
-        sdict[key]              = get_ini_value(key, sdict[key])
+# After an error the session may have a failed transaction, a temporary
+# table or a lock left - the next file gets a new connection
+def drop_pooled_connection(conf):
+    key                         = get_connection_key(conf)
+    if (key not in connection_pool):
+        return
     
-    return sdict
+    try:
+        connection_pool[key].close()
+    except Exception:
+        pass
+    del connection_pool[key]
 
 
-def read_csv_file(conf, fn):
-    global application_issues_list
-    dchar                       = conf["csv"]["delimiter"]
-    qchar                       = conf["csv"]["quotechar"]
-    sql_get_next_id             = get_next_id_query(conf)
-    
-    rowcnt                      = 0
-    inscnt                      = 0
-    updcnt                      = 0
-    skipcnt                     = 0
-    
-    # with open('eggs.csv', newline='') as csvfile:
-    with open(fn) as fh:
-        reader                  = csv.reader(fh, delimiter=dchar, quotechar=qchar)
-        
-        diff_print("\"STATUS\",\"DATABASE_COLUMN\",\"DATABASE_VALUE\",\"LINE\",\"{0}\"".format(os.path.basename(fn)))
-        
-        for csvrow in reader:
-            rowcnt              = rowcnt + 1
-            conf["current_csv_line"] = rowcnt
-            increment_column_val= None
-            
-            debug_print("csv {0}> {1}".format(rowcnt, csvrow))
-            
-            if (len(conf["csv2db_fields_map"].keys()) != len(csvrow)):
-                raise Exception("CSV Line: {0}; Number of fields mismatch. Expected {1}, got {2}. Invalid CSV file.".format(rowcnt, len(conf["csv2db_fields_map"].keys()), len(csvrow)))
-            
-            row                 = []
-            for col in csvrow:
-                row.append(col.strip()) # Trim spaces
-            csvrow              = row.copy()
-            
-            csvrowdict          = get_csv_row_dict(conf, csvrow)
-            sql_select          = get_select_query(conf, csvrow)
-            sql                 = ""
-            
-            if (sql_select == ""):
-                #skipcnt         = skipcnt + 1
-                #continue ### Nah, this is not a minor exception, so we will crash
-                raise Exception("CSV Line: {0}; Blank value for a key column. All values for key columns must not be blank. Invalid CSV file.".format(rowcnt))
-            
-            debug_print("EXECUTING: {0}".format(sql_select))
-            
-            cursor.execute(sql_select)
-            total_records       = cursor.rowcount
-            debug_print("Total SELECTed rows: {0}".format(total_records))
-            # results                     = cursor.fetchall()
-            
-            if (total_records > 1):
-                print()
-                print("PROBLEM: More than one record found, as a result of this SELECT. This is not what we expect. The keys you specify in your INI, section [get_database_data].keys_list must uniquely identify only one record. Unless somebody messed-up your database.")
-                print("SELECT: {0}".format(sql_select))
-                print("Key columns: {0}".format(conf["select"]["keys_list"]))
-                raise Exception("Key columns do not identify uniqely one record or multiple records exist in database.")
-            
-            # We have 1 result
-            dbrowdict           = {}
-            for dbrow in cursor:
-                debug_print("SELECT: {0}".format(dbrow))
-                
-                dbrowdict       = get_db_row_dict(conf, dbrow)
-                
-                for colname in list(conf["update"]["columns_list"]):
-                    csvcolname  = conf["db2csv_fields_map"][colname]
-                    dbval       = dbrowdict[colname]
-                    csvval      = csvrowdict[csvcolname]
-                    valtype     = conf["column_types"][colname]
-                    
-                    # Special situation - if value type is not varchar,
-                    # then if we get empty value in the CSV, it should be
-                    # interpreted as NULL
-                    if (valtype == "other" and csvval == ''):
-                        csvval  = None
-                    
-                    if ("null_equals_to_empty" in conf["select"] and valtype == "varchar" and dbval == None):
-                        dbval   = ''
-                    
-                    debug_print(">>>> compare: (db)'{0}' != '{1}'(csv)".format(dbval, csvval))
-                    if (dbval != csvval):
-                        sql     = get_update_query(conf, csvrow)
-                        regular_print("[{0}] updating: {1}".format(rowcnt, csvrowdict))
-                        diff_print("\"diff\",\"{0}\",\"{1}\",\"{2}\",\"{3}\"".format(colname, dbval, rowcnt, csvrow))
-                        updcnt  = updcnt + 1
-                        break
-            
-            if (total_records == 0):
-                cursor.execute(sql_get_next_id)
-                singlerow       = cursor.fetchone()
-                increment_column_val = singlerow[0] # Single value
-                debug_print("next id: {0}".format(increment_column_val))
-                sql             = get_insert_query(conf, csvrow, increment_column_val)
-                regular_print("[{0}] inserting: {1}".format(rowcnt, csvrowdict))
-                diff_print("\"NEW\",\"\",\"\",\"{0}\",\"{1}\"".format(rowcnt, csvrow))
-                inscnt          = inscnt + 1
-            
-            
-            # If anything to do (values exist and differ)
-            debug_print("EXECUTING: {0}".format(sql))
-            if (not debug_mode and not diff_mode):
-                if (sql != ""):
-                    cursor.execute(sql)
-                    connection.commit()
-                else:
-                    print("[{0}] skipping: {1}".format(rowcnt, csvrowdict))
-                    skipcnt     = skipcnt + 1
-            else:
-                debug_print("SQL query not executed, because of DEBUG_MODE being enabled.")
-    
-    print()
-    print()
-    print("[SUMMARY] total:{0}, inserts:{1}, updates:{2}, skips:{3}".format(rowcnt, inscnt, updcnt, skipcnt))
-    diff_print("total differences found:{0}".format(inscnt+updcnt))
- 
+def close_connection_pool():
+    for key in list(connection_pool.keys()):
+        connection_pool[key].close()
+        del connection_pool[key]
+
 
 def check_prerequisites():
     if (not os.path.isdir(confpath)):
@@ -325,14 +3882,31 @@ def get_filenames():
     global debug_mode
     global verbose_mode
     global diff_mode
+    global quiet_mode
+    global resume_mode
     
     fn                          = sys.argv[1]
     conffn                      = "{0}/{1}".format(confpath, os.path.basename(fn))
     defaultsconf                = "{0}/defaults.ini".format(confpath)
+    ininame                     = None
     
-    if (len(sys.argv) - 1 > 1):
-        param2                  = sys.argv[2]
-        param2.lower()
+    # mycsv.csv.gz uses mycsv.ini too
+    extension                   = get_compressed_extension(fn)
+    if (extension != None):
+        conffn                  = conffn[:-len(extension)]
+    
+    global workers
+    global parsers
+    global jobs
+    global watch_mode
+    global fingerprints_action
+    global report_file
+    global diff_file
+    global progress_seconds
+    
+    params                      = sys.argv[2:]
+    while (len(params) > 0):
+        param2                  = params.pop(0).lower()
         
         if (param2 == "debug"):
             debug_mode          = True
@@ -342,6 +3916,71 @@ def get_filenames():
         
         if (param2 == "diff"):
             diff_mode           = True
+        
+        if (param2 == "quiet"):
+            quiet_mode          = True
+        
+        if (param2 == "resume"):
+            resume_mode         = True
+        
+        if (param2 == "--workers"):
+            if (len(params) == 0 or not params[0].isdigit() or int(params[0]) < 1):
+                raise Exception("--workers needs a number of processes.")
+            workers             = int(params.pop(0))
+        
+        if (param2 == "--parsers"):
+            if (len(params) == 0 or not params[0].isdigit() or int(params[0]) < 1):
+                raise Exception("--parsers needs a number of processes.")
+            parsers             = int(params.pop(0))
+        
+        if (param2 == "--jobs"):
+            if (len(params) == 0 or not params[0].isdigit() or int(params[0]) < 1):
+                raise Exception("--jobs needs a number of processes.")
+            jobs                = int(params.pop(0))
+        
+        if (param2 == "--watch"):
+            watch_mode          = True
+        
+        if (param2 == "--fingerprints"):
+            if (len(params) == 0 or params[0].lower() not in supported_fingerprint_actions):
+                raise Exception("--fingerprints needs one of: {0}".format(', '.join(supported_fingerprint_actions)))
+            fingerprints_action = params.pop(0).lower()
+        
+        if (param2 == "--report"):
+            if (len(params) == 0):
+                raise Exception("--report needs a file name.")
+            report_file         = params.pop(0)
+        
+        if (param2 == "--diff-file"):
+            if (len(params) == 0):
+                raise Exception("--diff-file needs a file name.")
+            diff_file           = params.pop(0)
+        
+        if (param2 == "--progress"):
+            if (len(params) == 0 or not params[0].isdigit() or int(params[0]) < 1):
+                raise Exception("--progress needs a number of seconds.")
+            progress_seconds    = int(params.pop(0))
+        
+        if (param2 == "--ini"):
+            if (len(params) == 0):
+                raise Exception("--ini needs the name of the INI file in conf/.")
+            ininame             = params.pop(0)
+    
+    # QUIET MODE shows the progress instead of the rows
+    if (quiet_mode and progress_seconds == 0):
+        progress_seconds        = quiet_progress_seconds
+    
+    if (fn == "-" and ininame == None):
+        raise Exception("Reading the standard input (-) needs --ini NAME.")
+    
+    # Each file of a batch has its own INI, unless --ini is given
+    if (is_csv_batch(fn) or watch_mode):
+        if (ininame != None):
+            return fn, get_ini_filename(ininame), defaultsconf
+        return fn, None, defaultsconf
+    
+    if (fn == "-"):
+        return fn, get_ini_filename(ininame), defaultsconf
     
     if (re.match(r'\/', fn)):
         fn                      = "{0}/{1}".format(csvpath_default, fn)
@@ -352,18 +3991,25 @@ def get_filenames():
         conffn                  = "{0}.ini".format(conffn)
         fn                      = "{0}.csv".format(fn)
     
+    if (ininame != None):
+        conffn                  = get_ini_filename(ininame)
+    
     return fn, conffn, defaultsconf
 
 
+def get_ini_filename(ininame):
+    return "{0}/{1}.ini".format(confpath, re.sub(r'\.ini$', '', ininame))
+
+
 def check_files(fn, conffn, defaultsconf):
     if (not os.path.exists(defaultsconf)):
         raise Exception("Config file not found: {0}".format(defaultsconf))
     if (not os.path.isfile(defaultsconf)):
         raise Exception("Not a file: {0}".format(defaultsconf))
     
-    if (not os.path.exists(fn)):
+    if (fn != "-" and not os.path.exists(fn)):
         raise Exception("File not found: {0}".format(fn))
-    if (not os.path.isfile(fn)):
+    if (fn != "-" and not os.path.isfile(fn)):
         raise Exception("Not a file: {0}".format(fn))
     
     if (not os.path.exists(conffn)):
@@ -372,6 +4018,37 @@ def check_files(fn, conffn, defaultsconf):
         raise Exception("Not a file: {0}".format(conffn))
 
 
+# defaults.ini and the INI of the CSV file
+def get_conf(conffn, defaultsconf):
+    config                      = configparser.ConfigParser()
+    conf                        = {
+        "db"        : {},
+        "conffn"    : conffn
+    }
+    
+    config.read(defaultsconf)   # Reading defaults.ini
+    
+    for db in config.sections():
+        conf["db"][db] = get_ini_section(dict(config.items(db)))
+    
+    config.read(conffn)         # Reading the actual INI
+    
+    dbconf                      = get_ini_section(dict(config.items('database')))
+    conf["csv"]                 = get_ini_section(dict(config.items('csv')))
+    conf["select"]              = get_ini_section(dict(config.items('get_database_data')))
+    conf["update"]              = get_ini_section(dict(config.items('update_database_data')))
+    conf["csv2db_fields_map"]   = get_ini_section(dict(config.items('database_mapping')))
+    
+    check_default_settings(conf, dbconf)                            # We also get many defaults here
+    set_column_types(conf)
+    set_csv_column_indexes(conf)
+    set_db2csv_fields_map(conf)
+    set_row_plan(conf)
+    set_query_cache(conf)
+    
+    return conf
+
+
 def check_default_settings(conf, dbconf):
     if ("type" not in dbconf):
         raise Exception("Database type not specified in INI file.")
@@ -381,11 +4058,15 @@ def check_default_settings(conf, dbconf):
     
     db                          = dbconf["type"].lower() # Just in case
     conf["db"]["type"]          = db
+    conf["backend"]             = get_database_backend(db)
+    
+    if (db not in conf["db"]):
+        conf["db"][db]          = {}
     
     for setting in dbconf:
         conf["db"][db][setting] = dbconf[setting]
     
-    for setting in required_database_settings:
+    for setting in conf["backend"].required_settings:
         if setting not in conf["db"][db]:
             raise Exception("Required database setting not found: {0}".format(setting))
     
@@ -436,135 +4117,264 @@ def set_column_types(conf):
     conf["column_types"]        = types
 
 
-def format_value(conf, col, val):
-    if (conf["column_types"][col] == "varchar"):
-        val                     = "'{0}'".format(val.strip())
+# Everything the per-row functions need, worked out once: where each
+# column is in the CSV row and in the database row and how its value
+# is converted. Entries are (column, CSV column, CSV index, converter).
+def set_row_plan(conf):
+    for column in conf["db2csv_fields_map"].keys():
+        if (column not in conf["column_types"]):
+            raise Exception("Column '{0}' from [database_mapping] is missing in [get_database_data].columns_list.".format(column))
+    
+    keys_list                   = conf["select"]["keys_list"]
+    update_columns              = conf["update"]["columns_list"]
+    db_columns                  = list(conf["column_types"].keys())
+    insert_columns              = list(conf["db2csv_fields_map"].keys())
+    
+    batch_update_columns        = list(keys_list)
+    for column in update_columns:
+        if (column not in batch_update_columns):
+            batch_update_columns.append(column)
+    
+    # (column, CSV index, database row index, is varchar)
+    compare                     = []
+    staging_compare             = []
+    for column in update_columns:
+        csvindex                = conf["index_map"][conf["db2csv_fields_map"][column]]
+        varchar                 = conf["column_types"][column] == "varchar"
+        compare.append((column, csvindex, db_columns.index(column), varchar))
+        staging_compare.append((column, insert_columns.index(column), insert_columns.index(column), varchar))
+    
+    # Keys of database rows are needed only by the batch lookups, which
+    # require all key columns in "columns_list"
+    key_db_indexes              = None
+    if (all(column in conf["column_types"] for column in keys_list)):
+        key_db_indexes          = tuple(db_columns.index(column) for column in keys_list)
+    
+    conf["row_plan"]            = {
+        "fields_count"          : len(conf["csv"]["fields_list"]),
+        "used_indexes"          : tuple(sorted(conf["index_map"][csvcol] for csvcol in conf["csv2db_fields_map"].keys())),
+        "keys"                  : get_plan_columns(conf, keys_list),
+        "insert"                : get_plan_columns(conf, insert_columns),
+        "update"                : get_plan_columns(conf, update_columns),
+        "batch_update"          : get_plan_columns(conf, batch_update_columns),
+        "db_row"                : get_plan_columns(conf, db_columns),
+        "compare"               : tuple(compare),
+        "staging_compare"       : tuple(staging_compare),
+        "staging_keys"          : tuple(insert_columns.index(column) for column in keys_list if column in insert_columns),
+        "key_db_indexes"        : key_db_indexes,
+        "null_equals_to_empty"  : "null_equals_to_empty" in conf["select"]
+    }
+    conf["predicate_row"]       = None
+
+
+def get_plan_columns(conf, columns):
+    plan_columns                = []
+    
+    for column in columns:
+        csvcol                  = None
+        index                   = None
+        if (column in conf["db2csv_fields_map"]):
+            csvcol              = conf["db2csv_fields_map"][column]
+            index               = conf["index_map"][csvcol]
+        
+        converter               = get_other_value
+        if (conf["column_types"].get(column) == "varchar"):
+            converter           = get_varchar_value
+        
+        plan_columns.append((column, csvcol, index, converter))
+    
+    return tuple(plan_columns)
+
+
+def get_varchar_value(val):
+    return val.strip()
+
+
+def get_other_value(val):
+    # Empty value of non-varchar column is NULL
+    if (val == ''):
+        return None
+    
     return val
 
 
+def set_query_cache(conf):
+    db                          = conf["db"]["type"]
+    conf["query_cache"]         = {}
+    conf["prepared"]            = {}
+    conf["prepared_statements"] = False
+    
+    if ("prepared_statements" in conf["db"][db] and conf["db"][db]["prepared_statements"].lower() == "yes"):
+        if (db != "postgresql"):
+            raise Exception("[database].prepared_statements is supported on PostgreSQL only.")
+        conf["prepared_statements"] = True
+
+
+def get_placeholders(count):
+    return ', '.join([sql_placeholder] * count)
+
+
+# Each query shape is created only once and then reused with different
+# parameters. The shape of the predicate depends on which key columns
+# have a value, so it is a part of the cache key.
+def get_query_template(conf, name, columns):
+    cachekey                    = (name, columns)
+    if (cachekey in conf["query_cache"]):
+        return conf["query_cache"][cachekey]
+    
+    db                          = conf["db"]["type"]
+    table                       = conf["db"][db]["table"]
+    
+    predicate                   = []
+    if (name in ["select", "update"]):
+        for column in columns:
+            predicate.append("{0} = {1}".format(column, sql_placeholder))
+    predicate                   = ' and '.join(predicate)
+    
+    if (name == "select"):
+        sql                     = "select {0} from {1} where {2};".format(', '.join(conf["column_types"].keys()), table, predicate)
+    
+    if (name == "update"):
+        set_clause              = []
+        for column in conf["update"]["columns_list"]:
+            set_clause.append("{0} = {1}".format(column, sql_placeholder))
+        sql                     = "update {0} set {1} where {2};".format(table, ', '.join(set_clause), predicate)
+    
+    # Here "columns" are the columns to insert
+    if (name == "insert"):
+        sql                     = "insert into {0} ({1}) values ({2});".format(table, ', '.join(columns), get_placeholders(len(columns)))
+    
+    # Here "columns" is the number of keys
+    if (name == "batch_select"):
+        keys                    = "({0})".format(get_placeholders(len(conf["select"]["keys_list"])))
+        sql                     = "select {0} from {1} where ({2}) in ({3});".format(', '.join(conf["column_types"].keys()), table, ', '.join(conf["select"]["keys_list"]), ', '.join([keys] * columns))
+    
+    conf["query_cache"][cachekey] = sql
+    return sql
+
+
+# With [database].prepared_statements = yes each query shape is prepared
+# once on the server and executed with EXECUTE, so it is planned only once
+def prepare_query(conf, sql, params):
+    if (not conf["prepared_statements"]):
+        return sql, params
+    
+    if (sql not in conf["prepared"]):
+        name                    = "csv_import_{0}".format(len(conf["prepared"]) + 1)
+        count                   = 0
+        if (params != None):
+            count               = len(params)
+        
+        pgsql                   = sql.rstrip(";")
+        for i in range(count):
+            pgsql               = pgsql.replace(sql_placeholder, "${0}".format(i + 1), 1)
+        
+        debug_print("EXECUTING: prepare {0} as {1};", name, pgsql)
+        cursor.execute("prepare {0} as {1};".format(name, pgsql))
+        
+        if (count == 0):
+            conf["prepared"][sql] = "execute {0};".format(name)
+        else:
+            conf["prepared"][sql] = "execute {0} ({1});".format(name, get_placeholders(count))
+    
+    return conf["prepared"][sql], params
+
+
+def execute_query(conf, sql, params=None):
+    sql, params                 = prepare_query(conf, sql, params)
+    
+    if (params == None):
+        cursor.execute(sql)
+    else:
+        cursor.execute(sql, params)
+
+
 def get_predicate(conf, csvdata):
     global application_issues_list
-    i                           = 0
-    predicate                   = ""
+    
+    # The lookup, the UPDATE and the INSERT of the same row all need it
+    if (conf["predicate_row"] is csvdata):
+        return conf["predicate"]
+    
+    columns                     = []
+    params                      = []
     rowcnt                      = conf["current_csv_line"]
     
-    for column in conf["select"]["keys_list"]:
-        csvcol                  = conf["db2csv_fields_map"][column]
-        csvcol_index            = conf["index_map"][csvcol]
+    for column, csvcol, csvcol_index, converter in conf["row_plan"]["keys"]:
         val                     = csvdata[csvcol_index]
         
         # Key columns cannot be empty
         if (val == None or val == ""):
-            add_application_issue(csv_file_issue, "[Ln:{0}][Col:{1}] Empty value for key column '{2}'.".format(rowcnt, csvcol_index, csvcol))
+            add_application_issue(csv_file_issue, rowcnt, "[Col:{0}] Empty value for key column '{1}'.".format(csvcol_index, csvcol))
             continue
         
-        val                     = format_value(conf, column, val)
-        i                       = i + 1
-        
-        if (i == 1):
-            predicate           = "{0} {1} = {2}".format(predicate, column, val)
-        else:
-            predicate           = "{0} and {1} = {2}".format(predicate, column, val)
+        columns.append(column)
+        params.append(converter(val))
     
-    return predicate
+    conf["predicate_row"]       = csvdata
+    conf["predicate"]           = (tuple(columns), params)
+    
+    return conf["predicate"]
 
 
 def get_select_query(conf, csvdata):
-    db                          = conf["db"]["type"]
-    column_list                 = conf["column_types"].keys()
-    predicate                   = get_predicate(conf, csvdata)
+    columns, params             = get_predicate(conf, csvdata)
     
-    if (predicate == ""):
-        return ""
-    
-    sql                         = "select {0} from {1} where {2};".format(', '.join(column_list), conf["db"][db]["table"], predicate)
+    if (len(columns) == 0):
+        return "", None
     
     if "select" in conf["select"]:
-        sql                     = conf["select"]["select"]
+        return conf["select"]["select"], None
     
-    return sql
+    return get_query_template(conf, "select", columns), params
+
+
+def get_batch_select_query(conf, keys):
+    keys_list                   = conf["select"]["keys_list"]
+    
+    params                      = []
+    for key in keys:
+        for i in range(len(keys_list)):
+            params.append(conf["row_plan"]["keys"][i][3](key[i]))
+    
+    return get_query_template(conf, "batch_select", len(keys)), params
 
 
 def get_update_query(conf, csvdata):
-    db                          = conf["db"]["type"]
-    column_list                 = conf["update"]["columns_list"]
-    predicate                   = get_predicate(conf, csvdata)
+    columns, predicate_params   = get_predicate(conf, csvdata)
     
-    if (predicate == ""):
-        return ""
-        
-    i                           = 0
-    set_clause                  = ""
-    for column in column_list:
-        i                       = i + 1
-        csvcol                  = conf["db2csv_fields_map"][column]
-        csvcol_index            = conf["index_map"][csvcol]
-        val                     = csvdata[csvcol_index]
-        val                     = format_value(conf, column, val)
-        
-        if (i == 1):
-            set_clause          = "{0} {1} = {2}".format(set_clause, column, val)
-        else:
-            set_clause          = "{0}, {1} = {2}".format(set_clause, column, val)
+    if (len(columns) == 0):
+        return "", None
     
-    sql                         = "update {0} set{1} where {2};".format(conf["db"][db]["table"], set_clause, predicate)
+    params                      = get_plan_values(conf["row_plan"]["update"], csvdata)
     
-    return sql
+    return get_query_template(conf, "update", columns), params + predicate_params
     
 
 def get_next_id_query(conf):
     db                          = conf["db"]["type"]
     column_list                 = conf["update"]["columns_list"]
     column                      = conf["update"]["increment_column"]
-    sql                         = "select max({0}) + 1 as next_id from {1};".format(column, conf["db"][db]["table"])
+    sql                         = "select coalesce(max({0}), 0) + 1 as next_id from {1};".format(column, conf["db"][db]["table"])
     
     return sql
 
 
 def get_insert_query(conf, csvdata, nextid=None):
-    db                          = conf["db"]["type"]
-    column_list                 = list(conf["db2csv_fields_map"].keys())
-    predicate                   = get_predicate(conf, csvdata)
-    
-    if (predicate == ""):
-        return ""
-        
-    values                      = []
-    for column in column_list:
-        csvcol                  = conf["db2csv_fields_map"][column]
-        csvcol_index            = conf["index_map"][csvcol]
-        val                     = csvdata[csvcol_index]
-        val                     = format_value(conf, column, val)
-        values.append(val)
-    
-    if (nextid):
-        increment_column        = conf["update"]["increment_column"]
-        column_list.append(increment_column)
-        values.append(str(nextid))
-    
-    sql                         = "insert into {0} ({1}) values ({2});".format(conf["db"][db]["table"], ', '.join(column_list), ', '.join(values))
-    
-    return sql
-
-
-def get_db_row_dict(conf, dbrow):
-    column_list                 = list(conf["column_types"].keys())
-    results                     = {}
+    plan_columns                = conf["row_plan"]["insert"]
+    column_list                 = [column[0] for column in plan_columns]
+    columns, predicate_params   = get_predicate(conf, csvdata)
     
-    for i in range(len(column_list)):
-        results[column_list[i]] = dbrow[i]
+    if (len(columns) == 0):
+        return "", None
     
-    return results
-
-
-def get_csv_row_dict(conf, csvrow):
-    column_list                 = conf["csv"]["fields_list"]
-    results                     = {}
+    params                      = get_plan_values(plan_columns, csvdata)
     
-    for i in range(len(column_list)):
-        results[column_list[i]] = csvrow[i]
+    if (nextid != None):
+        column_list.append(conf["update"]["increment_column"])
+        params.append(nextid)
     
-    return results
+    return get_query_template(conf, "insert", tuple(column_list)), params
 
 
 
@@ -578,6 +4388,8 @@ try:
     
     check_prerequisites()
     fn, conffn, defaultsconf    = get_filenames()
+    set_run_stats()
+    set_stdout_buffer()
     
     if (debug_mode):
         print("***DEBUG AND VERBOSE MODE ENABED***")
@@ -588,53 +4400,48 @@ try:
     elif (diff_mode):
         print("***DIFF MODE ENABLED***")
         print()
+    elif (quiet_mode):
+        print("***QUIET MODE ENABLED***")
+        print()
     
-    print("PARSING: {0}".format(fn))
-    print()
-    
-    check_files(fn, conffn, defaultsconf)
-    
-    global config
-    global conf
-    config                      = configparser.ConfigParser()
-    conf                        = {
-        "db"        : {}
-    }
-    
-    config.read(defaultsconf)   # Reading defaults.ini
-    
-    for db in config.sections():
-        conf["db"][db] = get_ini_section(dict(config.items(db)))
-    
-    config.read(conffn)         # Reading the actual INI
-    
-    dbconf                      = get_ini_section(dict(config.items('database')))
-    conf["csv"]                 = get_ini_section(dict(config.items('csv')))
-    conf["select"]              = get_ini_section(dict(config.items('get_database_data')))
-    conf["update"]              = get_ini_section(dict(config.items('update_database_data')))
-    conf["csv2db_fields_map"]   = get_ini_section(dict(config.items('database_mapping')))
-    
-    check_default_settings(conf, dbconf)                            # We also get many defaults here
-    set_column_types(conf)
-    set_csv_column_indexes(conf)
-    set_db2csv_fields_map(conf)
-    
-    debug_print("Current config:")
-    debug_print(pp.pformat(conf))
-    debug_print("")
-    
-    connection                  = get_database_connection(conf)     # Connect to database
-    cursor                      = connection.cursor()
-    
-    # csv_content = get_csv_file_content(conf, fn)
-    read_csv_file(conf, fn)
+    if (watch_mode):
+        summary, failed         = watch_csv_dir(fn, conffn, defaultsconf)
+    elif (is_csv_batch(fn)):
+        print("BATCH: {0}".format(fn))
+        print()
+        
+        summary, failed         = import_csv_batch(fn, conffn, defaultsconf)
+    else:
+        print("PARSING: {0}".format(fn))
+        print()
+        
+        check_files(fn, conffn, defaultsconf)
+        conf                    = get_conf(conffn, defaultsconf)
+        failed                  = []
+        
+        if (verbose_mode or debug_mode):
+            debug_print("Current config:")
+            debug_print(pp.pformat(conf))
+            debug_print("")
+        
+        connection              = get_database_connection(conf)     # Connect to database
+        cursor                  = connection.cursor()
+        
+        # csv_content = get_csv_file_content(conf, fn)
+        summary                 = import_csv_file(conf, fn)
+        
+        # Close connections
+        cursor.close()
+        connection.close()
     
-    # Close connections
-    cursor.close()
-    connection.close()
+    if (report_file != None):
+        write_run_report(fn, summary)
     
     print_all_application_issues()
     
+    if (len(failed) > 0):
+        raise Exception("{0} CSV files failed: {1}".format(len(failed), ', '.join(failed)))
+    
     print()
     print("Application end.")
 
@@ -645,9 +4452,12 @@ except Exception as e:
     
     print()
     print("--------------------[ EXCEPTION")
+    sys.stdout.flush()
     sys.exit("{0} ({1}); Code line: {2};".format(e, exc_type, exc_tb.tb_lineno))
 
 finally:
+    sys.stdout.flush()
+    
     # Release the connection
     if cursor:
         cursor.close()
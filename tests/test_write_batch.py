@@ -0,0 +1,86 @@
+# Runs csv_import_update.py on a SQLite database, the same way as from
+# the command line: python -m pytest tests
+
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+
+package_dir                     = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ini_template                    = """[database]
+type                            = sqlite
+name                            = {0}
+table                           = people
+
+[csv]
+fields_list                     = "first_name_csv","last_name_csv","account_csv","city_csv"
+delimiter                       = ,
+quotechar                       = "
+
+[get_database_data]
+columns_list                    = "first_name_varchar","last_name_varchar","account_number","city_varchar"
+keys_list                       = "first_name","last_name","city"
+null_equals_to_empty            = yes
+
+[update_database_data]
+columns_list                    = "account_number"
+increment_column                = people_id
+write_batch_size                = {1}
+
+[database_mapping]
+first_name_csv                  = first_name
+last_name_csv                   = last_name
+city_csv                        = city
+account_csv                     = account_number
+"""
+
+
+def run_import(tmp_path, csvdata, write_batch_size):
+    os.mkdir(str(tmp_path / "conf"))
+    shutil.copy(os.path.join(package_dir, "csv_import_update.py"), str(tmp_path))
+    shutil.copy(os.path.join(package_dir, "conf", "defaults.ini"), str(tmp_path / "conf"))
+    
+    dbfn                        = str(tmp_path / "people.db")
+    db                          = sqlite3.connect(dbfn)
+    db.execute("create table people (people_id int not null, first_name text, last_name text, account_number text, city text, unique (first_name, last_name, city));")
+    db.execute("insert into people values (1, 'Max', 'Cavalera', '3333', 'Sao Paulo'), (2, 'Kai', 'Hansen', '1', null);")
+    db.commit()
+    db.close()
+    
+    (tmp_path / "conf" / "people.ini").write_text(ini_template.format(dbfn, write_batch_size))
+    (tmp_path / "people.csv").write_text(csvdata)
+    
+    result                      = subprocess.run([sys.executable, "csv_import_update.py", "people.csv", "quiet"], cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    
+    db                          = sqlite3.connect(dbfn)
+    rows                        = db.execute("select first_name, last_name, account_number, city from people order by people_id;").fetchall()
+    db.close()
+    
+    return result, rows
+
+
+# A row with an empty key column ("city is null") must not share the
+# batch UPDATE of the rows with a complete key
+def test_empty_key_column_in_update_batch(tmp_path):
+    csvdata                     = '"Kai","Hansen","2",""\n"Max","Cavalera","4444","Sao Paulo"\n"Ron","Padavona","555","Houston"\n'
+    result, rows                = run_import(tmp_path, csvdata, 100)
+    
+    assert result.returncode == 0, result.stdout
+    assert "[SUMMARY] total:3, inserts:1, updates:2, skips:0" in result.stdout
+    assert rows == [("Max", "Cavalera", "4444", "Sao Paulo"), ("Kai", "Hansen", "2", None), ("Ron", "Padavona", "555", "Houston")]
+
+
+def test_write_batch_same_as_row_mode(tmp_path):
+    csvdata                     = '"Kai","Hansen","2",""\n"Max","Cavalera","4444","Sao Paulo"\n"Ron","Padavona","555",""\n"Ron","Padavona","556","Houston"\n'
+    
+    os.mkdir(str(tmp_path / "row"))
+    os.mkdir(str(tmp_path / "batch"))
+    row_result, row_rows        = run_import(tmp_path / "row", csvdata, 1)
+    batch_result, batch_rows    = run_import(tmp_path / "batch", csvdata, 100)
+    
+    assert row_result.returncode == 0, row_result.stdout
+    assert batch_result.returncode == 0, batch_result.stdout
+    assert batch_rows == row_rows